@@ -1,5 +1,9 @@
 import heapq
+import threading
+from collections import deque
 from copy import deepcopy
+from pyhop import LRUCache
+from symmetry import least_image, apply
 
 
 def a_star_search(start, agent, goal, steps):
@@ -44,5 +48,207 @@ def expand(current, agent, steps):
     return expansion
 
 
+# the moves the staghunt step operators make, in the order plan() tries them
+GRID_MOVES = (('step_up', 0, -1), ('step_down', 0, 1), ('step_left', -1, 0), ('step_right', 1, 0))
+
+
+class _Node:
+    # a_star_search queues states that never order before one another, so
+    # ties on f pop in an order set by the heap alone; nodes behave the same
+    __slots__ = ('loc', 'path')
+
+    def __init__(self, loc, path):
+        self.loc = loc
+        self.path = path
+
+    def __lt__(self, other):
+        return False
+
+
+# a_star_search on the map itself: moves go to any cell of grid that is > 0,
+# and the result is the list of move names (None if there is no path)
+def a_star_grid(grid, start, goal, moves=GRID_MOVES):
+    frontier = []
+    heapq.heappush(frontier, (0, _Node(start, None)))
+    closed = set()
+    gscores = {start: 0}
+
+    while len(frontier) > 0:
+        node = heapq.heappop(frontier)[1]
+        current_loc = node.loc
+        if current_loc == goal:
+            path = []
+            link = node.path
+            while link is not None:
+                path.append(link[0])
+                link = link[1]
+            path.reverse()
+            return path
+        if current_loc in closed: continue
+
+        closed.add(current_loc)
+        x, y = current_loc
+        temp_g = gscores[current_loc] + 1
+        for name, dx, dy in moves:
+            if grid[x+dx][y+dy] > 0:
+                next_loc = (x+dx, y+dy)
+                if next_loc not in gscores or temp_g < gscores[next_loc]:
+                    gscores[next_loc] = temp_g
+                next_f = temp_g + abs(next_loc[0] - goal[0]) + abs(next_loc[1] - goal[1])
+                heapq.heappush(frontier, (next_f, _Node(next_loc, (name, node.path))))
+
+
 def distance(loc1, loc2):
     return abs(loc1[0] - loc2[0]) + abs(loc1[1] - loc2[1])
+
+
+# geodesic distances from every cell to each of goals, as an int array of
+# shape (len(goals), width, height) with -1 where a goal can't be reached;
+# all goals are searched breadth first together, one frontier per goal laid
+# out in a single flat array, so each step costs only its frontier's size
+def distance_fields(grid, goals):
+    import numpy as np
+    passable = np.asarray(grid) > 0
+    # a border of walls keeps every neighbour inside its own goal's slab
+    width, height = passable.shape[0] + 2, passable.shape[1] + 2
+    padded = np.zeros((width, height), dtype=bool)
+    padded[1:-1, 1:-1] = passable
+    size = width * height
+    unvisited = np.tile(padded.ravel(), len(goals))
+    fields = np.full(len(goals) * size, -1, dtype=np.int32)
+    if len(goals) > 0:
+        xs, ys = np.array(goals).T
+        frontier = np.arange(len(goals)) * size + (xs + 1) * height + (ys + 1)
+        fields[frontier] = 0
+        unvisited[frontier] = False
+        offsets = np.array([-1, 1, -height, height])
+        d = 0
+        while frontier.size:
+            d += 1
+            reached = (frontier[:, None] + offsets).ravel()
+            frontier = np.unique(reached[unvisited[reached]])
+            unvisited[frontier] = False
+            fields[frontier] = d
+    fields = fields.reshape(len(goals), width, height)
+    return np.ascontiguousarray(fields[:, 1:-1, 1:-1])
+
+
+# distance_fields for a single goal without numpy, as a list of columns
+def _bfs_field(grid, goal):
+    field = [[-1] * len(column) for column in grid]
+    field[goal[0]][goal[1]] = 0
+    queue = deque([goal])
+    while queue:
+        x, y = queue.popleft()
+        d = field[x][y] + 1
+        for _, dx, dy in GRID_MOVES:
+            nx, ny = x+dx, y+dy
+            if 0 <= nx < len(grid) and 0 <= ny < len(grid[nx]) and grid[nx][ny] > 0 and field[nx][ny] < 0:
+                field[nx][ny] = d
+                queue.append((nx, ny))
+    return field
+
+
+# cells of distance fields a MapAnalysis keeps, 16 MB of int32 per map, and
+# that analyze() keeps for all the maps together
+FIELD_CELLS = 1 << 22
+ANALYSES_CELLS = 1 << 24
+
+
+# maps never change during a simulation, so everything about getting around
+# one is worked out once and kept in a MapAnalysis, shared through analyze().
+# sims in a thread pool share it too, so its caches are only touched under
+# its lock, and the fields and steps are worked out outside it
+class MapAnalysis:
+
+    def __init__(self, grid, max_fields=1024, max_steps=65536, max_cells=FIELD_CELLS):
+        self.grid = grid
+        # goal -> steps from each cell to goal (all pairs for modest maps),
+        # as many as fit in max_cells on large ones
+        area = len(grid) * len(grid[0])
+        self.fields = LRUCache(max(1, min(max_fields, max_cells // area)))
+        self.cells = self.fields.maxsize * area
+        # (start, goal) -> first move of a_star_grid's path
+        self.steps = LRUCache(max_steps)
+        self.lock = threading.Lock()
+
+    # steps from every cell to goal, as field[x][y] (-1 where goal can't be reached)
+    def distances(self, goal):
+        with self.lock:
+            field = self.fields.get(goal)
+        if field is None:
+            field = self._fields([goal])[0]
+            with self.lock:
+                self.fields.put(goal, field)
+        return field
+
+    # work out the fields for all of goals at once, vectorized when possible
+    def fetch(self, goals):
+        with self.lock:
+            missing = list(dict.fromkeys([goal for goal in goals if goal not in self.fields.entries]))
+        # no more at once than the cache holds
+        for i in range(0, len(missing), self.fields.maxsize):
+            batch = missing[i:i+self.fields.maxsize]
+            fields = self._fields(batch)
+            with self.lock:
+                for goal, field in zip(batch, fields):
+                    self.fields.put(goal, field)
+
+    def _fields(self, goals):
+        try:
+            return distance_fields(self.grid, goals)
+        except ImportError:
+            return [_bfs_field(self.grid, goal) for goal in goals]
+
+    # the fields distance() will want for goals. a symmetry of the map takes
+    # the distances to a goal onto those to its image, so only the least
+    # image of each goal needs a field
+    def prefetch(self, goals):
+        self.fetch([least_image(self.grid, goal)[0] for goal in goals])
+
+    # length of the shortest path, None if there is none
+    def distance(self, start, goal):
+        goal, t = least_image(self.grid, goal)
+        x, y = apply(t, start, len(self.grid), len(self.grid[0]))
+        d = self.distances(goal)[x][y]
+        return None if d < 0 else int(d)
+
+    # the move plan() takes from start towards goal, None if goal can't be reached
+    def next_step(self, start, goal):
+        key = (start, goal)
+        with self.lock:
+            step = self.steps.get(key, False)
+        if step is False:
+            path = a_star_grid(self.grid, start, goal)
+            step = path[0] if path else None
+            with self.lock:
+                self.steps.put(key, step)
+        return step
+
+
+_analyses = LRUCache(64)
+_analyses_lock = threading.Lock()
+_last = (None, None)
+
+
+# the MapAnalysis for grid, keyed by the map's contents so that copies of a
+# map share one. _last is read once, as another thread may replace it
+def analyze(grid):
+    global _last
+    last = _last
+    if last[0] is grid:
+        return last[1]
+    key = tuple([tuple(column) for column in grid])
+    with _analyses_lock:
+        analysis = _analyses.get(key)
+        if analysis is None:
+            analysis = MapAnalysis(key)
+            _analyses.put(key, analysis)
+            # forget the least recently used maps if their fields could outgrow
+            # ANALYSES_CELLS
+            entries = _analyses.entries
+            while len(entries) > 1 and sum(a.cells for a in entries.values()) > ANALYSES_CELLS:
+                entries.popitem(last=False)
+                _analyses.evictions += 1
+    _last = (grid, analysis)
+    return analysis
@@ -0,0 +1,333 @@
+import numpy as np
+from copy import deepcopy
+from collections import OrderedDict
+from a_start import analyze, GRID_MOVES
+from models.compact import HUNTER, STAG, RABBIT, ROLE_BITS
+from models.staghunt_htn import HuntState
+
+# the staghunt rules run in lockstep over a batch of episodes held as NumPy
+# arrays, one row per episode and one column per agent. agents take their
+# turns in the order of the roster, as sim_all takes them in state.agents
+# order, with every episode's turn for an agent done at once, and then the
+# captures are made. this follows the HTN model step for step, including
+# its backtracking:
+#
+# - a hunter with a cooperateWith goal goes for the free stag closest to it
+#   and its partner together (if within 100), otherwise, or if it can't get
+#   there, for the closest free rabbit (if within 20), stepping along
+#   a_star_grid's path. if neither works it waits and picks nothing
+# - a stag with a hunter next to it (the first in the roster) steps away,
+#   trying move_away_up, down, left, right, then evade_up, down, left,
+#   right, into open cells without a hunter, or stays put
+# - rabbits wait
+# - every hunter makes one capture attempt per prey in its cell: a stag if
+#   the hunter is ready and another ready hunter is there too (6/n points
+#   each), otherwise a rabbit if it is ready (1 point)
+#
+# distances are Manhattan distances, as with GEODESIC off
+
+BIG = 1 << 30
+MOVES = np.array([(dx, dy) for _, dx, dy in GRID_MOVES])
+STEP_CODES = dict((name, i) for i, (name, _, _) in enumerate(GRID_MOVES))
+AT_GOAL = len(GRID_MOVES)
+NO_PATH = -1
+UNKNOWN = -2
+
+# bytes of next steps a batch keeps, one row of cells per (map, goal)
+TABLE_CELLS = 1 << 24
+
+# the stag's escape routes, in the order survive's move_away_from tries them:
+# (dx, dy, test on stag (sx, sy) and hunter (ex, ey))
+ESCAPES = (
+    (0, -1, lambda sx, sy, ex, ey: ey > sy),
+    (0, 1, lambda sx, sy, ex, ey: ey < sy),
+    (-1, 0, lambda sx, sy, ex, ey: ex > sx),
+    (1, 0, lambda sx, sy, ex, ey: ex < sx),
+    (0, -1, lambda sx, sy, ex, ey: (sx != ex) & (sy == ey)),
+    (0, 1, lambda sx, sy, ex, ey: (sx != ex) & (sy == ey)),
+    (-1, 0, lambda sx, sy, ex, ey: (sx == ex) & (sy != ey)),
+    (1, 0, lambda sx, sy, ex, ey: (sx == ex) & (sy != ey)),
+)
+
+
+# B episodes as arrays. all episodes share one roster, the agents of each
+# being a subsequence of it; agents an episode doesn't have are off the map
+class Batch:
+
+    def __init__(self, roster, grids, map_id):
+        B, A = len(map_id), len(roster)
+        self.roster = tuple(roster)
+        self.ids = dict((agent, i) for i, agent in enumerate(self.roster))
+        self.roles = np.array([ROLE_BITS.get(agent[1], 0) for agent in self.roster], np.int8)
+        self.hunters = np.flatnonzero(self.roles == HUNTER)
+        self.stags = np.flatnonzero(self.roles == STAG)
+        self.rabbits = np.flatnonzero(self.roles == RABBIT)
+        self.prey = np.flatnonzero((self.roles == STAG) | (self.roles == RABBIT))
+        # the maps as given, and padded with walls to one shape
+        self.grids = list(grids)
+        width = max(len(grid) for grid in self.grids)
+        height = max(len(grid[0]) for grid in self.grids)
+        self.grid = np.zeros((len(self.grids), width, height), np.int8)
+        for m, grid in enumerate(self.grids):
+            self.grid[m, :len(grid), :len(grid[0])] = grid
+        self.height = height
+        self.map_id = np.asarray(map_id, np.intp)
+        # first move of a_star_grid's path from each cell to a goal, filled
+        # in as needed: slots maps (map, goal) to a row of rows, the least
+        # recently used going once there are max_goals of them
+        self.cells = width * height
+        self.max_goals = max(1, TABLE_CELLS // self.cells)
+        self.slots = OrderedDict()
+        self.rows = np.full((min(self.max_goals, 64), self.cells), UNKNOWN, np.int8)
+        self.present = np.zeros((B, A), bool)
+        self.x = np.zeros((B, A), np.int16)
+        self.y = np.zeros((B, A), np.int16)
+        self.alive = np.zeros((B, A), bool)
+        self.captured = np.zeros((B, A), bool)
+        self.score = np.zeros((B, A), np.int32)
+        self.scored = np.zeros((B, A), bool)
+        self.ready = np.zeros((B, A), bool)
+        self.target = np.full((B, A), -1, np.int16)
+        # the agent a hunter is told to cooperate with, and the targets it
+        # last picked by itself and with its partner
+        self.partner = np.full((B, A), -1, np.int16)
+        self.hunt = np.full((B, A), -1, np.int16)
+        self.hunt_with = np.full((B, A), -1, np.int16)
+        # the goals the episodes started with
+        self.goals = [{} for _ in range(B)]
+
+    def __len__(self):
+        return len(self.map_id)
+
+    # a batch of tuple-keyed staghunt states
+    @classmethod
+    def from_states(cls, states):
+        roster = list(max((state.agents for state in states), key=len))
+        for state in states:
+            it = iter(roster)
+            if not all(agent in it for agent in state.agents):
+                raise ValueError('agents of %s are not in the order of %s' % (state.agents, roster))
+        grids = []
+        keys = {}
+        map_id = []
+        for state in states:
+            key = tuple(map(tuple, state.map))
+            if key not in keys:
+                keys[key] = len(grids)
+                grids.append(state.map)
+            map_id.append(keys[key])
+        batch = cls(roster, grids, map_id)
+        ids = batch.ids
+        for b, state in enumerate(states):
+            for agent in state.agents:
+                batch.present[b, ids[agent]] = True
+            for agent, loc in state.loc.items():
+                a = ids[agent]
+                batch.x[b, a], batch.y[b, a] = loc
+                batch.alive[b, a] = True
+            for agent in state.captured:
+                batch.captured[b, ids[agent]] = True
+            for agent, score in state.score.items():
+                batch.score[b, ids[agent]] = score
+                batch.scored[b, ids[agent]] = True
+            for agent in state.ready:
+                batch.ready[b, ids[agent]] = True
+            for agent, target in state.target.items():
+                batch.target[b, ids[agent]] = ids[target]
+            for agent, goal in state.goal.items():
+                if 'cooperateWith' in goal and goal['cooperateWith'][0] == agent:
+                    batch.partner[b, ids[agent]] = ids[goal['cooperateWith'][1]]
+            batch.goals[b] = deepcopy(state.goal)
+        return batch
+
+    # the episodes as tuple-keyed states. captured and ready are listed in
+    # roster order, and the goals are the starting ones plus the hunt and
+    # huntWith entries the targeting rules add
+    def to_states(self):
+        states = []
+        roster = self.roster
+        for b in range(len(self)):
+            state = HuntState('batch')
+            state.agents = tuple(roster[a] for a in np.flatnonzero(self.present[b]))
+            state.map = self.grids[self.map_id[b]]
+            state.loc = dict((roster[a], (int(self.x[b, a]), int(self.y[b, a]))) for a in np.flatnonzero(self.alive[b]))
+            state.target = dict((roster[a], roster[self.target[b, a]]) for a in np.flatnonzero(self.target[b] >= 0))
+            state.goal = deepcopy(self.goals[b])
+            for a in np.flatnonzero(self.hunt[b] >= 0):
+                state.goal.setdefault(roster[a], {})['hunt'] = (roster[a], roster[self.hunt[b, a]])
+            for a in np.flatnonzero(self.hunt_with[b] >= 0):
+                state.goal[roster[a]]['huntWith'] = (roster[a], roster[self.hunt_with[b, a]], roster[self.partner[b, a]])
+            state.assumes = {}
+            state.captured = [roster[a] for a in np.flatnonzero(self.captured[b])]
+            state.score = dict((roster[a], int(self.score[b, a])) for a in np.flatnonzero(self.scored[b]))
+            state.ready = [roster[a] for a in np.flatnonzero(self.ready[b])]
+            states.append(state)
+        return states
+
+    # code of the first move from (sx, sy) to (gx, gy) in each episode:
+    # an index into GRID_MOVES, AT_GOAL or NO_PATH
+    def next_steps(self, sx, sy, gx, gy):
+        start = sx.astype(np.intp) * self.height + sy
+        goal = gx.astype(np.intp) * self.height + gy
+        keys, inverse = np.unique(self.map_id * self.cells + goal, return_inverse=True)
+        rows = self._slots(keys.tolist())[inverse.ravel()]
+        codes = self.rows[rows, start]
+        unknown = codes == UNKNOWN
+        if unknown.any():
+            pairs = set(zip(rows[unknown].tolist(), self.map_id[unknown].tolist(), start[unknown].tolist(), goal[unknown].tolist()))
+            for row, m, s, g in pairs:
+                s_loc, g_loc = divmod(s, self.height), divmod(g, self.height)
+                if s_loc == g_loc:
+                    code = AT_GOAL
+                else:
+                    step = analyze(self.grids[m]).next_step(s_loc, g_loc)
+                    code = NO_PATH if step is None else STEP_CODES[step]
+                self.rows[row, s] = code
+            codes = self.rows[rows, start]
+        return codes
+
+    # the rows of the (map, goal) keys, making new ones for keys without
+    def _slots(self, keys):
+        for key in keys:
+            if key in self.slots:
+                self.slots.move_to_end(key)
+        # the keys asked for now all keep their rows
+        self.max_goals = max(self.max_goals, len(keys))
+        found = np.empty(len(keys), np.intp)
+        for i, key in enumerate(keys):
+            slot = self.slots.get(key)
+            if slot is None:
+                if len(self.slots) < self.max_goals:
+                    slot = len(self.slots)
+                    if slot == len(self.rows):
+                        more = np.full((min(len(self.rows), self.max_goals - slot), self.cells), UNKNOWN, np.int8)
+                        self.rows = np.concatenate([self.rows, more])
+                else:
+                    _, slot = self.slots.popitem(last=False)
+                    self.rows[slot] = UNKNOWN
+                self.slots[key] = slot
+            found[i] = slot
+        return found
+
+    # one sim_all step of every episode
+    def step(self):
+        for a, role in enumerate(self.roles):
+            if role == HUNTER:
+                self._hunt(a)
+            elif role == STAG:
+                self._survive(a)
+        self._capture()
+
+    def run(self, steps):
+        for _ in range(steps):
+            self.step()
+
+    def _closest(self, a, candidates, extra=None):
+        rows = np.arange(len(self))
+        xs, ys = self.x[:, candidates].astype(np.int64), self.y[:, candidates].astype(np.int64)
+        d = np.abs(xs - self.x[:, a, None]) + np.abs(ys - self.y[:, a, None])
+        if extra is not None:
+            d += np.abs(xs - extra[0][:, None]) + np.abs(ys - extra[1][:, None])
+        d = np.where(self.alive[:, candidates], d, BIG)
+        # the first of the closest in roster order, as the strict < scan finds
+        k = np.argmin(d, axis=1)
+        return candidates[k], d[rows, k]
+
+    def _hunt(self, a):
+        rows = np.arange(len(self))
+        acting = self.alive[:, a]
+        chosen = np.full(len(self), -1, np.intp)
+        codes = np.full(len(self), NO_PATH, np.int8)
+        coop = np.zeros(len(self), bool)
+        # cooperate: pick_coop_target
+        partner = self.partner[:, a].astype(np.intp)
+        p = np.maximum(partner, 0)
+        has = acting & (partner >= 0) & self.alive[rows, p]
+        if has.any() and len(self.stags):
+            target, best = self._closest(a, self.stags, (self.x[rows, p].astype(np.int64), self.y[rows, p].astype(np.int64)))
+            ok = has & (best < 100)
+            code = self.next_steps(self.x[:, a], self.y[:, a], self.x[rows, target], self.y[rows, target])
+            ok &= code != NO_PATH
+            chosen[ok] = target[ok]
+            codes[ok] = code[ok]
+            coop = ok
+        # betray: pick_closest_target, also where cooperating came to nothing
+        rest = acting & (chosen < 0)
+        if rest.any() and len(self.rabbits):
+            target, best = self._closest(a, self.rabbits)
+            ok = rest & (best < 20)
+            code = self.next_steps(self.x[:, a], self.y[:, a], self.x[rows, target], self.y[rows, target])
+            ok &= code != NO_PATH
+            chosen[ok] = target[ok]
+            codes[ok] = code[ok]
+        picked = chosen >= 0
+        self.target[picked, a] = chosen[picked]
+        self.ready[picked, a] = True
+        self.hunt_with[coop, a] = chosen[coop]
+        alone = picked & ~coop
+        self.hunt[alone, a] = chosen[alone]
+        move = picked & (codes >= 0) & (codes < AT_GOAL)
+        self.x[move, a] += MOVES[codes[move], 0]
+        self.y[move, a] += MOVES[codes[move], 1]
+
+    def _survive(self, a):
+        sx, sy = self.x[:, a], self.y[:, a]
+        hx, hy = self.x[:, self.hunters], self.y[:, self.hunters]
+        alive = self.alive[:, self.hunters]
+        near = alive & (np.abs(hx - sx[:, None]) + np.abs(hy - sy[:, None]) < 2)
+        fleeing = self.alive[:, a] & near.any(axis=1)
+        if not fleeing.any():
+            return
+        rows = np.arange(len(self))
+        first = np.argmax(near, axis=1)
+        ex, ey = hx[rows, first], hy[rows, first]
+        moved = np.zeros(len(self), bool)
+        width, height = self.grid.shape[1:]
+        for dx, dy, test in ESCAPES:
+            nx, ny = sx + dx, sy + dy
+            free = ~(alive & (hx == nx[:, None]) & (hy == ny[:, None])).any(axis=1)
+            open_ = self.grid[self.map_id, np.clip(nx, 0, width-1), np.clip(ny, 0, height-1)] > 0
+            ok = fleeing & ~moved & test(sx, sy, ex, ey) & free & open_
+            self.x[ok, a] = nx[ok]
+            self.y[ok, a] = ny[ok]
+            moved |= ok
+
+    def _capture(self):
+        # capture_prey counts the attempts before any capture is made
+        px, py = self.x[:, self.prey], self.y[:, self.prey]
+        alive = self.alive[:, self.prey]
+        counts = [(alive & (px == self.x[:, h, None]) & (py == self.y[:, h, None])).sum(axis=1) * self.alive[:, h] for h in self.hunters]
+        for h, count in zip(self.hunters, counts):
+            for k in range(int(count.max(initial=0))):
+                self._attempt(h, count > k)
+
+    def _attempt(self, h, mask):
+        rows = np.arange(len(self))
+        here = self.alive & (self.x == self.x[:, h, None]) & (self.y == self.y[:, h, None])
+        # attempt_stag_capture: capture_stag needs another ready hunter
+        stag_here = here[:, self.stags]
+        stag = self.stags[np.argmax(stag_here, axis=1)] if len(self.stags) else np.zeros(len(self), np.intp)
+        has_stag = stag_here.any(axis=1) if len(self.stags) else np.zeros(len(self), bool)
+        helpers = here[:, self.hunters] & self.ready[:, self.hunters]
+        n = helpers.sum(axis=1) + ~helpers[:, np.searchsorted(self.hunters, h)]
+        caught = mask & has_stag & self.ready[:, h] & (n > 1)
+        if caught.any():
+            share = np.where(caught, 6 // np.maximum(n, 1), 0)
+            hunting = helpers & caught[:, None]
+            hunting[:, np.searchsorted(self.hunters, h)] |= caught
+            for j, hunter in enumerate(self.hunters):
+                self.score[hunting[:, j], hunter] += share[hunting[:, j]]
+                self.ready[hunting[:, j], hunter] = False
+            self.alive[caught, stag[caught]] = False
+            self.captured[caught, stag[caught]] = True
+        # attempt_rabbit_capture, if there was no stag or it got away
+        rest = mask & ~caught
+        rabbit_here = here[:, self.rabbits]
+        if not len(self.rabbits):
+            return
+        rabbit = self.rabbits[np.argmax(rabbit_here, axis=1)]
+        caught = rest & rabbit_here.any(axis=1) & self.ready[:, h]
+        self.score[caught, h] += 1
+        self.ready[caught, h] = False
+        self.alive[caught, rabbit[caught]] = False
+        self.captured[caught, rabbit[caught]] = True
@@ -0,0 +1,69 @@
+# the goal sets decide() chooses from, for any number of hunters. a goal set
+# is a coalition structure: a partition of the hunters into coalitions, the
+# hunters of each coalition cooperating with one another, each with the
+# next one round the coalition, and the hunters on their own not
+# cooperating with anyone. for h1, h2 and h3 they come out as assignGoals'
+# goal sets 0 to 4:
+#
+#   ((h1,), (h2,), (h3,))    everyone on their own
+#   ((h1, h2), (h3,))
+#   ((h1, h3), (h2,))
+#   ((h1,), (h2, h3))
+#   ((h1, h2, h3),)          all together
+#
+# there are Bell(n) of them for n hunters, so they are generated one at a
+# time, the structures with the most coalitions first. hunters take their
+# turns in roster order, so even hunters standing in the same cell don't
+# score alike under swapped goals, and every structure is simulated
+
+
+def hunters(state):
+    return [agent for agent in state.agents if agent[1] == 'hunter']
+
+
+# every partition of the agents, as a tuple of coalitions in the order of
+# their first members, each in the order of agents. the partitions into k
+# coalitions come before those into k-1, and among those the order is that
+# of their restricted growth strings (the coalition of each agent in turn)
+def partitions(agents):
+    agents = tuple(agents)
+    for k in range(len(agents), 0, -1):
+        for string in growth_strings(len(agents), k):
+            blocks = [[] for _ in range(k)]
+            for agent, b in zip(agents, string):
+                blocks[b].append(agent)
+            yield tuple(map(tuple, blocks))
+
+
+# the restricted growth strings of length n using k values, in
+# lexicographic order
+def growth_strings(n, k, prefix=(), top=-1):
+    if len(prefix) == n:
+        yield prefix
+        return
+    left = n - len(prefix)
+    for b in range(min(top+1, k-1) + 1):
+        # the values still to come must be able to reach k-1
+        if k-1 - max(top, b) <= left-1:
+            yield from growth_strings(n, k, prefix + (b,), max(top, b))
+
+
+# the goals of a coalition structure, as assignGoals sets them
+def goals(partition):
+    goal = {}
+    for coalition in partition:
+        if len(coalition) > 1:
+            for i, hunter in enumerate(coalition):
+                goal[hunter] = {'cooperateWith': (hunter, coalition[(i+1) % len(coalition)])}
+    return goal
+
+
+# (i, partition) for the partitions of the hunters, i counting from 0.
+# without grand, the partition into a single coalition is left out
+def goal_sets(hunters, grand=True):
+    i = 0
+    for partition in partitions(hunters):
+        if not grand and len(partition) == 1 and len(hunters) > 1:
+            continue
+        yield i, partition
+        i += 1
@@ -0,0 +1,136 @@
+import os
+import numpy as np
+import shards
+
+# a sweep converted to NumPy structured arrays, one .npy file per table, read
+# back memory-mapped so an analysis only pages in the slices it touches.
+#
+#   agents.npy  (A,)     name, role of every agent seen in the sweep
+#   maps.npy    (M,)     grid (padded with walls), width, height
+#   runs.npy    (R,)     condition (i,j,k), sim c, number of states, map
+#   steps.npy   (R, S)   per state of each run, indexed by agent:
+#                        loc (x, y), -1 when the agent is off the map
+#                        captured, score
+#                        partner (the agent cooperated with) and
+#                        target, agent indices or -1
+#
+# runs with fewer than S states are padded with loc -1
+
+AGENT = np.dtype([('name', 'U8'), ('role', 'U8')])
+
+
+def _run_dtype():
+    return np.dtype([('condition', 'i1', (3,)), ('sim', 'i4'), ('steps', 'i4'), ('map', 'i4')])
+
+
+def _map_dtype(width, height):
+    return np.dtype([('grid', 'i1', (width, height)), ('width', 'i2'), ('height', 'i2')])
+
+
+# counts and agent indices are i4, as runs can be far longer than 32767
+# states and sweeps far wider than 32767 agents. coordinates fit in i2
+def _step_dtype(n):
+    return np.dtype([('loc', 'i2', (n, 2)), ('captured', '?', (n,)), ('score', 'i4', (n,)),
+                     ('partner', 'i4', (n,)), ('target', 'i4', (n,))])
+
+
+# write the runs of path (all.pickle or a shard directory) to directory. the
+# runs are read twice, once to size the tables and once to fill steps.npy
+# in place. from a shard directory only one run is in memory at a time. an
+# all.pickle can only be unpickled whole, so it is read once and kept
+def convert(path, directory):
+    if os.path.isdir(path):
+        read = lambda: shards.iter_runs(path)
+    else:
+        loaded = list(shards.iter_runs(path))
+        read = lambda: loaded
+    runs = []
+    agents = {}
+    maps = {}
+    for key, (states, plans) in read():
+        length = 0
+        for state in states:
+            if not length:
+                grid = tuple(map(tuple, state.map))
+                maps.setdefault(grid, len(maps))
+            for agent in state.agents:
+                agents.setdefault(agent, len(agents))
+            length += 1
+        runs.append((key, maps[grid], length))
+    n = len(agents)
+    steps = max(length for _, _, length in runs)
+    width = max(len(grid) for grid in maps)
+    height = max(len(grid[0]) for grid in maps)
+
+    table = np.zeros(n, AGENT)
+    for agent, a in agents.items():
+        table[a] = agent
+    grids = np.zeros(len(maps), _map_dtype(width, height))
+    for grid, m in maps.items():
+        grids['grid'][m, :len(grid), :len(grid[0])] = grid
+        grids['width'][m] = len(grid)
+        grids['height'][m] = len(grid[0])
+    index = np.zeros(len(runs), _run_dtype())
+    for r, (key, m, length) in enumerate(runs):
+        index[r] = (key[:3], key[3], length, m)
+
+    os.makedirs(directory, exist_ok=True)
+    for name, array in (('agents', table), ('maps', grids), ('runs', index)):
+        np.save(os.path.join(directory, name + '.npy'), array)
+    data = np.lib.format.open_memmap(os.path.join(directory, 'steps.npy'), 'w+', _step_dtype(n), (len(runs), steps))
+    for r, (key, (states, plans)) in enumerate(read()):
+        rows = np.zeros(steps, data.dtype)
+        rows['loc'] = -1
+        rows['partner'] = -1
+        rows['target'] = -1
+        for s, state in enumerate(states):
+            row = rows[s]
+            for agent, loc in state.loc.items():
+                row['loc'][agents[agent]] = loc
+            for agent in state.captured:
+                row['captured'][agents[agent]] = True
+            for agent, score in state.score.items():
+                row['score'][agents[agent]] = score
+            for agent, goal in state.goal.items():
+                if 'cooperateWith' in goal:
+                    row['partner'][agents[agent]] = agents[goal['cooperateWith'][1]]
+            for agent, target in state.target.items():
+                if target in agents:
+                    row['target'][agents[agent]] = agents[target]
+        data[r] = rows
+    data.flush()
+    del data
+
+
+# the tables of a converted sweep, memory-mapped read only
+class ColumnarStore:
+
+    def __init__(self, directory):
+        load = lambda name: np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+        self.agents = load('agents')
+        self.maps = load('maps')
+        self.runs = load('runs')
+        self.steps = load('steps')
+
+    # column of an agent in the step arrays, by name
+    def agent(self, name):
+        return int(np.flatnonzero(self.agents['name'] == name)[0])
+
+    # indices of the runs of a condition, any of i, j, k may be None
+    def condition(self, i=None, j=None, k=None):
+        mask = np.ones(len(self.runs), bool)
+        for axis, val in enumerate((i, j, k)):
+            if val is not None:
+                mask &= self.runs['condition'][:, axis] == val
+        return np.flatnonzero(mask)
+
+    # the map of run r, as lists like state.map
+    def map(self, r):
+        m = self.maps[self.runs['map'][r]]
+        return m['grid'][:m['width'], :m['height']].tolist()
+
+
+if __name__ == '__main__':
+    import sys
+    # python columnar.py all.pickle|shard-dir out-dir
+    convert(sys.argv[1], sys.argv[2])
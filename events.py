@@ -0,0 +1,81 @@
+import pickle
+import print_trace as pt
+
+# structured events in place of print() on the hot paths of the model and
+# the simulator. callers guard every emit with
+#
+#     if events.enabled:
+#         events.emit('kind', arg, ...)
+#
+# so a disabled channel costs one attribute lookup and nothing is formatted.
+# an event is a kind string and the raw arguments; sinks are called with
+# (kind, args) and have to be done with the arguments when they return, as
+# callers pass live state that keeps changing
+
+enabled = False
+sinks = []
+
+
+def emit(kind, *args):
+    for sink in sinks:
+        sink(kind, args)
+
+
+# route events to the given sinks, e.g.
+# events.enable(events.PrintSink()) for the old console output, or
+# events.enable(events.FileSink('events.pickle')) during a sweep
+def enable(*new_sinks):
+    global enabled
+    sinks.extend(new_sinks)
+    enabled = bool(sinks)
+
+
+# stop emitting and close the sinks
+def disable():
+    global enabled
+    enabled = False
+    while sinks:
+        sink = sinks.pop()
+        if hasattr(sink, 'close'):
+            sink.close()
+
+
+# prints events to stdout, maps and plans the way print_trace lays them out
+class PrintSink:
+    def __call__(self, kind, args):
+        if kind == 'map':
+            pt.print_map(*args)
+        elif kind == 'plan':
+            pt.print_plan(*args)
+        else:
+            print(kind, *args)
+
+
+# appends pickled (kind, args) records to a file through a large buffer.
+# the arguments are pickled as they arrive, so later changes to the state
+# don't show up in the log
+class FileSink:
+    def __init__(self, path, buffering=1<<20):
+        self.file = open(path, 'wb', buffering=buffering)
+        self.pickler = pickle.Pickler(self.file, pickle.HIGHEST_PROTOCOL)
+
+    def __call__(self, kind, args):
+        self.pickler.dump((kind, args))
+        # every record stands alone
+        self.pickler.clear_memo()
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+# the (kind, args) records of a FileSink log, in order
+def read_events(path):
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
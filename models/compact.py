@@ -0,0 +1,462 @@
+from array import array
+from collections.abc import MutableMapping, MutableSequence
+from copy import deepcopy
+import events
+import models.staghunt_htn as staghunt
+from a_start import analyze
+from models.staghunt_htn import HuntState, SHARED, INFINITY
+
+# a compact layout for staghunt states. agents are numbered by their place in
+# state.agents, roles are bits, and locations, scores and targets live in
+# arrays indexed by agent id, with an index of the agents in each cell. the
+# rules that look at every agent have id-based versions here, which DOMAIN
+# plans with, and the rest of the model's methods and operators read and
+# write state.loc[agent], state.score[agent], state.captured and so on,
+# which are tuple-keyed views onto the arrays, so they run unchanged, and so
+# do print_trace and to_json. the goals and assumptions stay nested dicts
+
+HUNTER = 1
+STAG = 2
+RABBIT = 4
+PREY = STAG | RABBIT
+ROLE_BITS = {'hunter': HUNTER, 'stag': STAG, 'rabbit': RABBIT}
+
+# the variables of a compact state, for pyhop.state_vars
+VARIABLES = ('map', 'agents', 'xs', 'ys', 'scores', 'scored', 'captured_ids', 'ready_ids', 'targets', 'goal', 'assumes')
+
+# the agents of a run, shared by all its states: the agent tuples, their ids,
+# their role bits and the ids of each role
+class Roster:
+	__slots__ = ('agents', 'ids', 'roles', 'members')
+
+	def __init__(self, agents):
+		self.agents = tuple(agents)
+		self.ids = {agent: i for i, agent in enumerate(self.agents)}
+		self.roles = bytes(ROLE_BITS.get(agent[1], 0) for agent in self.agents)
+		self.members = dict((bit, tuple(i for i, role in enumerate(self.roles) if role == bit)) for bit in ROLE_BITS.values())
+
+	def __reduce__(self):
+		return (Roster, (self.agents,))
+
+
+# hunts() on agent ids
+def hunts_id(roster, i, j):
+	return roster.roles[i] == HUNTER and roster.roles[j] & PREY != 0
+
+
+# target_distance() on agent ids, with xs and ys as lists and analysis the
+# map's analysis if distances are geodesic
+def target_distance_id(xs, ys, i, j, analysis):
+	if xs[i] < 0 or xs[j] < 0:
+		return INFINITY
+	if analysis is None:
+		return abs(xs[i] - xs[j]) + abs(ys[i] - ys[j])
+	d = analysis.distance((xs[i], ys[i]), (xs[j], ys[j]))
+	return INFINITY if d is None else d
+
+
+# what the id-based rules read of a state: the locations as lists (one call
+# each, however the planner wraps the arrays), the captured ids, and the
+# map's analysis with the fields of every candidate target worked out, if
+# distances are geodesic
+def survey(state, role):
+	xs, ys = state.xs.tolist(), state.ys.tolist()
+	analysis = None
+	if staghunt.GEODESIC:
+		analysis = analyze(state.map)
+		analysis.prefetch([(xs[j], ys[j]) for j in state.roster.members[role] if xs[j] >= 0])
+	return xs, ys, set(state.captured_ids), analysis
+
+
+# staghunt.closest_rabbit on agent ids
+def closest_rabbit(state, agent):
+	roster = state.roster
+	i = roster.ids[agent]
+	xs, ys, captured, analysis = survey(state, RABBIT)
+	best = ('', INFINITY)
+	for j in roster.members[RABBIT]:
+		if hunts_id(roster, i, j) and j not in captured:
+			d = target_distance_id(xs, ys, i, j, analysis)
+			if d < best[1]:
+				best = (roster.agents[j], d)
+	return best
+
+
+# staghunt.closest_stag on agent ids
+def closest_stag(state, agent, other):
+	roster = state.roster
+	i = roster.ids[agent]
+	k = roster.ids[other]
+	xs, ys, captured, analysis = survey(state, STAG)
+	best = ('', INFINITY)
+	for j in roster.members[STAG]:
+		if hunts_id(roster, i, j) and j not in captured:
+			d = target_distance_id(xs, ys, i, j, analysis) + target_distance_id(xs, ys, k, j, analysis)
+			if d < best[1]:
+				best = (roster.agents[j], d)
+				if events.enabled:
+					events.emit('coop_candidate', agent, best)
+	return best
+
+
+def pick_closest_target(state, agent):
+	return staghunt.aim_at_rabbit(state, agent, closest_rabbit(state, agent))
+
+
+def pick_coop_target(state, agent, other):
+	if events.enabled:
+		events.emit('pick_coop', agent, other)
+	return staghunt.aim_at_stag(state, agent, other, closest_stag(state, agent, other))
+
+
+# the staghunt domain with the id-based operators in place of the tuple
+# ones. planners of compact states use it, and make the same plans
+DOMAIN = staghunt.load_domain(pick_coop_target, pick_closest_target)
+
+
+class CompactState:
+	__slots__ = ('__name__', 'roster', 'views', 'index') + VARIABLES
+	variables = VARIABLES
+	constants = SHARED
+	domain = DOMAIN
+
+	def __init__(self, name, agents, map=None):
+		n = len(agents)
+		self.__name__ = name
+		self.roster = agents if isinstance(agents, Roster) else Roster(agents)
+		self.agents = self.roster.agents
+		self.map = map
+		# -1 for an agent that is not on the map
+		self.xs = array('h', [-1]) * n
+		self.ys = array('h', [-1]) * n
+		self.scores = array('i', [0]) * n
+		# 1 for the agents that have a score
+		self.scored = array('b', [0]) * n
+		self.captured_ids = []
+		self.ready_ids = []
+		# id of each agent's target, -1 for none
+		self.targets = array('i', [-1]) * n
+		self.goal = {}
+		self.assumes = {}
+		self.attach()
+
+	# the tuple-keyed views, made once for each state, and no index of cells
+	# until one is asked for
+	def attach(self):
+		self.views = (LocView(self), ScoreView(self), TargetView(self), IdList(self, 'captured_ids'), IdList(self, 'ready_ids'))
+		self.index = None
+
+	# the agents in each cell, by role: {(x, y): {role: [agent, ...]}}. the
+	# index is rebuilt if the location arrays have been replaced since
+	def cells(self):
+		index = self.index
+		if index is None or index[0] is not self.xs or index[1] is not self.ys:
+			cells = {}
+			agents = self.agents
+			ys = self.ys
+			for i, x in enumerate(self.xs):
+				if x >= 0:
+					cells.setdefault((x, ys[i]), {}).setdefault(agents[i][1], []).append(agents[i])
+			index = self.index = (self.xs, self.ys, cells)
+		return index[2]
+
+	# move agent i to (x, y), or off the map for x = -1. locations are only
+	# written here, so the index follows along
+	def place(self, i, x, y):
+		cells = self.cells()
+		agent = self.agents[i]
+		if self.xs[i] >= 0:
+			loc = (self.xs[i], self.ys[i])
+			roles = cells[loc]
+			agents = roles[agent[1]]
+			agents.remove(agent)
+			if not agents:
+				del roles[agent[1]]
+				if not roles:
+					del cells[loc]
+		self.xs[i] = x
+		self.ys[i] = y
+		if x >= 0:
+			cells.setdefault((x, y), {}).setdefault(agent[1], []).append(agent)
+
+	# assigning to a view replaces its arrays rather than writing into them,
+	# as copies may share them
+
+	@property
+	def loc(self):
+		return self.views[0]
+
+	@loc.setter
+	def loc(self, locs):
+		n = len(self.agents)
+		self.xs = array('h', [-1]) * n
+		self.ys = array('h', [-1]) * n
+		view = LocView(self)
+		for agent, loc in locs.items():
+			view[agent] = loc
+
+	@property
+	def score(self):
+		return self.views[1]
+
+	@score.setter
+	def score(self, scores):
+		n = len(self.agents)
+		self.scores = array('i', [0]) * n
+		self.scored = array('b', [0]) * n
+		view = ScoreView(self)
+		for agent, score in scores.items():
+			view[agent] = score
+
+	@property
+	def target(self):
+		return self.views[2]
+
+	@target.setter
+	def target(self, targets):
+		self.targets = array('i', [-1]) * len(self.agents)
+		view = TargetView(self)
+		for agent, target in targets.items():
+			view[agent] = target
+
+	@property
+	def captured(self):
+		return self.views[3]
+
+	@captured.setter
+	def captured(self, agents):
+		self.captured_ids = [self.roster.ids[agent] for agent in agents]
+
+	@property
+	def ready(self):
+		return self.views[4]
+
+	@ready.setter
+	def ready(self, agents):
+		self.ready_ids = [self.roster.ids[agent] for agent in agents]
+
+	# the compact version of a tuple-keyed state
+	@classmethod
+	def from_state(cls, state):
+		new = cls(state.__name__, state.agents, state.map)
+		new.loc = state.loc
+		new.score = state.score
+		new.captured = state.captured
+		new.ready = state.ready
+		new.target = state.target
+		new.goal, new.assumes = deepcopy((state.goal, state.assumes))
+		return new
+
+	# a tuple-keyed HuntState with the same variables
+	def to_state(self):
+		state = HuntState(self.__name__)
+		state.agents = self.agents
+		state.map = self.map
+		state.loc = dict(self.loc)
+		state.target = dict(self.target)
+		state.goal, state.assumes = deepcopy((self.goal, self.assumes))
+		state.captured = list(self.captured)
+		state.score = dict(self.score)
+		state.ready = list(self.ready)
+		return state
+
+	def __deepcopy__(self, memo):
+		new = CompactState.__new__(CompactState)
+		memo[id(self)] = new
+		new.__name__ = self.__name__
+		new.roster = self.roster
+		new.agents = self.agents
+		new.map = self.map
+		new.xs = self.xs[:]
+		new.ys = self.ys[:]
+		new.scores = self.scores[:]
+		new.scored = self.scored[:]
+		new.captured_ids = self.captured_ids[:]
+		new.ready_ids = self.ready_ids[:]
+		new.targets = self.targets[:]
+		new.goal = deepcopy(self.goal, memo)
+		new.assumes = deepcopy(self.assumes, memo)
+		new.attach()
+		if self.index is not None and self.index[0] is self.xs and self.index[1] is self.ys:
+			cells = {loc: {role: list(agents) for role, agents in roles.items()} for loc, roles in self.index[2].items()}
+			new.index = (new.xs, new.ys, cells)
+		return new
+
+	def __getstate__(self):
+		return (self.__name__, self.roster) + tuple(getattr(self, name) for name in VARIABLES)
+
+	def __setstate__(self, values):
+		self.__name__, self.roster = values[:2]
+		for name, val in zip(VARIABLES, values[2:]):
+			setattr(self, name, val)
+		self.attach()
+
+
+class LocView(MutableMapping):
+	__slots__ = ('state',)
+
+	def __init__(self, state):
+		self.state = state
+
+	# a copy of a view is a plain dict
+	def __deepcopy__(self, memo):
+		return dict(self)
+
+	def __getitem__(self, agent):
+		state = self.state
+		i = state.roster.ids.get(agent)
+		if i is None or state.xs[i] < 0:
+			raise KeyError(agent)
+		return (state.xs[i], state.ys[i])
+
+	def __contains__(self, agent):
+		i = self.state.roster.ids.get(agent)
+		return i is not None and self.state.xs[i] >= 0
+
+	def __setitem__(self, agent, loc):
+		self.state.place(self.state.roster.ids[agent], loc[0], loc[1])
+
+	def __delitem__(self, agent):
+		if agent not in self:
+			raise KeyError(agent)
+		self.state.place(self.state.roster.ids[agent], -1, -1)
+
+	def __iter__(self):
+		agents = self.state.agents
+		return (agents[i] for i, x in enumerate(self.state.xs) if x >= 0)
+
+	def __len__(self):
+		return sum(1 for x in self.state.xs if x >= 0)
+
+	# the agents of a role in a cell, in no particular order, as
+	# LocIndex.at gives them
+	def at(self, loc, role):
+		return self.state.cells().get(loc, {}).get(role, ())
+
+	def __repr__(self):
+		return repr(dict(self))
+
+
+class ScoreView(MutableMapping):
+	__slots__ = ('state',)
+
+	def __init__(self, state):
+		self.state = state
+
+	# a copy of a view is a plain dict
+	def __deepcopy__(self, memo):
+		return dict(self)
+
+	def __getitem__(self, agent):
+		i = self.state.roster.ids.get(agent)
+		if i is None or not self.state.scored[i]:
+			raise KeyError(agent)
+		return self.state.scores[i]
+
+	def __setitem__(self, agent, score):
+		i = self.state.roster.ids[agent]
+		self.state.scores[i] = score
+		self.state.scored[i] = 1
+
+	def __delitem__(self, agent):
+		self[agent]
+		i = self.state.roster.ids[agent]
+		self.state.scores[i] = self.state.scored[i] = 0
+
+	def __iter__(self):
+		agents = self.state.agents
+		return (agents[i] for i, scored in enumerate(self.state.scored) if scored)
+
+	def __len__(self):
+		return sum(self.state.scored)
+
+	def __repr__(self):
+		return repr(dict(self))
+
+
+class TargetView(MutableMapping):
+	__slots__ = ('state',)
+
+	def __init__(self, state):
+		self.state = state
+
+	# a copy of a view is a plain dict
+	def __deepcopy__(self, memo):
+		return dict(self)
+
+	def __getitem__(self, agent):
+		i = self.state.roster.ids.get(agent)
+		if i is None or self.state.targets[i] < 0:
+			raise KeyError(agent)
+		return self.state.agents[self.state.targets[i]]
+
+	def __setitem__(self, agent, target):
+		ids = self.state.roster.ids
+		self.state.targets[ids[agent]] = ids[target]
+
+	def __delitem__(self, agent):
+		self[agent]
+		self.state.targets[self.state.roster.ids[agent]] = -1
+
+	def __iter__(self):
+		agents = self.state.agents
+		return (agents[i] for i, t in enumerate(self.state.targets) if t >= 0)
+
+	def __len__(self):
+		return sum(1 for t in self.state.targets if t >= 0)
+
+	def __repr__(self):
+		return repr(dict(self))
+
+
+# a list of agents kept as a list of ids in one of the state's variables
+class IdList(MutableSequence):
+	__slots__ = ('state', 'name')
+
+	def __init__(self, state, name):
+		self.state = state
+		self.name = name
+
+	def __deepcopy__(self, memo):
+		return list(self)
+
+	def _ids(self):
+		return getattr(self.state, self.name)
+
+	def __getitem__(self, i):
+		agents = self.state.agents
+		if isinstance(i, slice):
+			return [agents[a] for a in self._ids()[i]]
+		return agents[self._ids()[i]]
+
+	def __setitem__(self, i, agent):
+		self._ids()[i] = self.state.roster.ids[agent]
+
+	def __delitem__(self, i):
+		del self._ids()[i]
+
+	def __len__(self):
+		return len(self._ids())
+
+	def __iter__(self):
+		return map(self.state.agents.__getitem__, self._ids())
+
+	def __contains__(self, agent):
+		i = self.state.roster.ids.get(agent)
+		return i is not None and i in self._ids()
+
+	def insert(self, i, agent):
+		self._ids().insert(i, self.state.roster.ids[agent])
+
+	def clear(self):
+		del self._ids()[:]
+
+	def extend(self, agents):
+		ids = self.state.roster.ids
+		self._ids().extend([ids[agent] for agent in agents])
+
+	def __eq__(self, other):
+		return list(self) == list(other)
+
+	def __repr__(self):
+		return repr(list(self))
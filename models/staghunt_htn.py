@@ -1,14 +1,157 @@
 import pyhop
-from a_start import a_star_search
+import events
+from copy import deepcopy
+from a_start import analyze
 import sys
 
 INFINITY = sys.maxsize
 
+# pick targets by the length of the shortest path on the map instead of by
+# Manhattan distance
+GEODESIC = False
+
+
+# state.loc that also keeps a reverse index from each cell to the agents
+# standing in it, by role, so the capture and evade rules don't have to scan
+# every agent. the operators assign to state.loc as before and the index
+# follows along
+class LocIndex(dict):
+	def __init__(self, *args, **kwargs):
+		dict.__init__(self)
+		self.cells = {}
+		self.update(*args, **kwargs)
+
+	def __setitem__(self, agent, loc):
+		if agent in self:
+			self._unindex(agent, dict.__getitem__(self, agent))
+		dict.__setitem__(self, agent, loc)
+		self.cells.setdefault(loc, {}).setdefault(agent[1], []).append(agent)
+
+	def __delitem__(self, agent):
+		self._unindex(agent, dict.__getitem__(self, agent))
+		dict.__delitem__(self, agent)
+
+	def _unindex(self, agent, loc):
+		roles = self.cells[loc]
+		agents = roles[agent[1]]
+		agents.remove(agent)
+		if not agents:
+			del roles[agent[1]]
+			if not roles:
+				del self.cells[loc]
+
+	def update(self, *args, **kwargs):
+		for agent, loc in dict(*args, **kwargs).items():
+			self[agent] = loc
+
+	def setdefault(self, agent, loc=None):
+		if agent not in self:
+			self[agent] = loc
+		return dict.__getitem__(self, agent)
+
+	def pop(self, agent, *default):
+		if agent not in self:
+			return dict.pop(self, agent, *default)
+		loc = dict.__getitem__(self, agent)
+		del self[agent]
+		return loc
+
+	def popitem(self):
+		agent, loc = dict.popitem(self)
+		self._unindex(agent, loc)
+		return agent, loc
+
+	def clear(self):
+		dict.clear(self)
+		self.cells.clear()
+
+	def copy(self):
+		new = LocIndex()
+		dict.update(new, self)
+		new.cells = {loc: {role: list(agents) for role, agents in roles.items()} for loc, roles in self.cells.items()}
+		return new
+
+	# agents and cells are tuples, so a copy is as good as a deep copy
+	def __deepcopy__(self, memo):
+		return self.copy()
+
+	# rebuild the index when copied or unpickled
+	def __reduce__(self):
+		return (LocIndex, (dict(self),))
+
+	# the agents of a role in a cell, in no particular order
+	def at(self, loc, role):
+		return self.cells.get(loc, {}).get(role, ())
+
+
+# maps never change, so every state of every run on a map shares one
+# read-only copy of it
+_maps = {}
+
+def intern_map(grid):
+	grid = tuple(map(tuple, grid))
+	return _maps.setdefault(grid, grid)
+
+
+# a state whose copies share what the model never changes. the map and a
+# tuple of agents are shared, loc, score, captured, ready and target only
+# hold tuples and ints so they are copied one level deep, and the rest (the
+# goals and assumptions, which the goal set sims alias) is deep copied with
+# one memo so they keep sharing what they shared
+SHARED = ('map',)
+SHALLOW = ('loc', 'score', 'captured', 'ready', 'target')
+
+class HuntState(pyhop.State):
+	# operators never change the shared variables either, so undo logs skip them
+	constants = SHARED
+
+	def __deepcopy__(self, memo):
+		new = HuntState.__new__(HuntState)
+		memo[id(self)] = new
+		copied = new.__dict__
+		for name, val in self.__dict__.items():
+			if name in SHARED or (name == 'agents' and type(val) is tuple):
+				copied[name] = val
+			elif name in SHALLOW or name == 'agents':
+				copied[name] = val.copy()
+			else:
+				copied[name] = deepcopy(val, memo)
+		return new
+
+
+# position of each agent in state.agents, rebuilt when the list changes.
+# _ranks is read once, as another thread may replace it
+_ranks = (None, {})
+
+def agent_rank(state):
+	global _ranks
+	ranks = _ranks
+	if ranks[0] is not state.agents:
+		ranks = (state.agents, {agent: i for i, agent in enumerate(state.agents)})
+		_ranks = ranks
+	return ranks[1]
+
+
+# whether loc knows the agents in each cell: a LocIndex, or the loc of a
+# models.compact state
+def indexed(loc):
+	return hasattr(loc, 'at')
+
+
+# the agents of a role in a cell, in the order of state.agents
+def agents_at(state, loc, role):
+	if indexed(state.loc):
+		found = state.loc.at(loc, role)
+		if len(found) > 1:
+			found = sorted(found, key=agent_rank(state).get)
+		return found
+	return [agent for agent in state.agents if agent[1] == role and agent in state.loc and state.loc[agent] == loc]
+
 # general start state with all the necessary fields, and some necessary values
 def get_start_state():
-    state = pyhop.State('init')
-    state.agents = [('r1', 'rabbit'), ('r2', 'rabbit'), ('s1', 'stag'), ('s2', 'stag'), ('s3', 'stag'), ('h1', 'hunter'), ('h2', 'hunter'), ('h3', 'hunter')]
-    state.loc = {}
+    state = HuntState('init')
+    state.agents = (('r1', 'rabbit'), ('r2', 'rabbit'), ('s1', 'stag'), ('s2', 'stag'), ('s3', 'stag'), ('h1', 'hunter'), ('h2', 'hunter'), ('h3', 'hunter'))
+    state.loc = LocIndex()
     state.map = None
     state.target = {}
     state.goal = {}
@@ -37,15 +180,30 @@ def distance(state, agent1, agent2):
 	else:
 		return INFINITY
 
+def path_distance(state, agent1, agent2):
+	if agent1 in state.loc and agent2 in state.loc:
+		d = analyze(state.map).distance(state.loc[agent1], state.loc[agent2])
+		if d is not None:
+			return d
+	return INFINITY
+
+
+def target_distance(state, agent1, agent2):
+	if GEODESIC:
+		return path_distance(state, agent1, agent2)
+	return distance(state, agent1, agent2)
+
+
+# work out the distance fields of every possible target in one batch
+def prefetch_targets(state, role):
+	analyze(state.map).prefetch([state.loc[a] for a in state.agents if a[1] == role and a in state.loc])
+
+
 def has_no_hunter(state, prey, loc):
-	for other_agent in state.agents:
-		# for each hunter
-		if hunts(other_agent, prey) and \
-				loc[0] == state.loc[other_agent][0] and \
-				loc[1] == state.loc[other_agent][1] :
-			# hunter is immediately to the right
-			return False
-	return True
+	# only stags and rabbits are hunted
+	if prey[1] != 'stag' and prey[1] != 'rabbit':
+		return True
+	return not agents_at(state, loc, 'hunter')
 
 
 ###########################################
@@ -69,15 +227,19 @@ def hunt(state, hunter):
 
 
 def plan(state, hunter, goal):
-	print('plan', hunter, state.loc[hunter], goal)
+	if events.enabled:
+		events.emit('plan_move', hunter, state.loc[hunter], goal)
 	if state.loc[hunter] == goal:
-		print('-at goal')
+		if events.enabled:
+			events.emit('at_goal', hunter)
 		return [('wait_one', hunter)]
-	p = a_star_search(state, hunter, goal, [step_up, step_down, step_left, step_right])
-	if p:
-		print('-plan to', p[0].__name__)
-		return [(p[0].__name__, hunter)]
-	print("no plan", hunter, goal)
+	step = analyze(state.map).next_step(state.loc[hunter], goal)
+	if step:
+		if events.enabled:
+			events.emit('next_step', hunter, step)
+		return [(step, hunter)]
+	if events.enabled:
+		events.emit('no_plan', hunter, goal)
 	return False
 
 
@@ -88,6 +250,16 @@ def mt_target(state, hunter):
 def survive(state, prey):
 	# if prey
 	if prey[1] == 'stag':
+		if indexed(state.loc):
+			# hunters in the stag's cell or next to it
+			hunters = []
+			if prey in state.loc:
+				x, y = state.loc[prey]
+				for loc in ((x, y), (x+1, y), (x-1, y), (x, y+1), (x, y-1)):
+					hunters.extend(state.loc.at(loc, 'hunter'))
+			if hunters:
+				return [('move_away_from', prey, min(hunters, key=agent_rank(state).get))]
+			return [('wait', prey)]
 		for agent in state.agents:
 			if agent[1] == 'hunter' and nearby(state, prey, agent):
 				return [('move_away_from', prey, agent)]
@@ -110,7 +282,8 @@ def cooperate(state, agent):
 
 
 def betray(state, agent):
-	print('betray', agent)
+	if events.enabled:
+		events.emit('betray', agent)
 	return [('pick_closest_target', agent)]
 
 
@@ -118,7 +291,8 @@ def betray(state, agent):
 def move_towards_up(state, agent, goal):
 	# if goal is a valid goal of agent
 	if state.loc[goal][1] < state.loc[agent][1]:
-		print('move towards up', agent, goal)
+		if events.enabled:
+			events.emit('move_towards', agent, goal, 'up')
 		return [('step_up', agent)]
 	else:
 		return False
@@ -126,7 +300,8 @@ def move_towards_up(state, agent, goal):
 
 def move_towards_down(state, agent, goal):
 	if state.loc[goal][1] > state.loc[agent][1]:
-		print('move towards up', agent, goal)
+		if events.enabled:
+			events.emit('move_towards', agent, goal, 'down')
 		return [('step_down', agent)]
 	else:
 		return False
@@ -134,7 +309,8 @@ def move_towards_down(state, agent, goal):
 
 def move_towards_left(state, agent, goal):
 	if state.loc[goal][0] < state.loc[agent][0]:
-		print('move towards up', agent, goal)
+		if events.enabled:
+			events.emit('move_towards', agent, goal, 'left')
 		return [('step_left', agent)]
 	else:
 		return False
@@ -142,7 +318,8 @@ def move_towards_left(state, agent, goal):
 
 def move_towards_right(state, agent, goal):
 	if state.loc[goal][0] > state.loc[agent][0]:
-		print('move towards up', agent, goal)
+		if events.enabled:
+			events.emit('move_towards', agent, goal, 'right')
 		return [('step_right', agent)]
 	else:
 		return False
@@ -214,24 +391,27 @@ def evade_right(state, agent, enemy):
 
 
 def capture_prey(state):
-	print('*capture prey*')
+	if events.enabled:
+		events.emit('capture_prey')
 	tasks = []
 	for agent in state.agents:
-		for target in state.agents:
-			if hunts(agent, target) and target in state.loc and state.loc[agent] == state.loc[target]:
-				tasks.append(('attempt_capture_target', agent))
+		if agent[1] == 'hunter':
+			# one attempt for every prey sharing the hunter's cell
+			loc = state.loc[agent]
+			prey = len(agents_at(state, loc, 'stag')) + len(agents_at(state, loc, 'rabbit'))
+			tasks.extend([('attempt_capture_target', agent)] * prey)
 	return tasks
 
 def attempt_stag_capture(state, hunter):
-	for target in state.agents:
-		if target[1] == 'stag' and target in state.loc and state.loc[hunter] == state.loc[target]:
-			return [('capture_stag', hunter, target)]
+	targets = agents_at(state, state.loc[hunter], 'stag')
+	if targets:
+		return [('capture_stag', hunter, targets[0])]
 	return False
 
 def attempt_rabbit_capture(state, hunter):
-	for target in state.agents:
-		if target[1] == 'rabbit' and target in state.loc and state.loc[hunter] == state.loc[target]:
-			return [('capture_rabbit', hunter, target)]
+	targets = agents_at(state, state.loc[hunter], 'rabbit')
+	if targets:
+		return [('capture_rabbit', hunter, targets[0])]
 	return False
 
 def attempt_no_capture(state, hunter):
@@ -241,6 +421,25 @@ def wait(state, agent):
 	return [('wait_one', agent)]
 
 
+# move_towards only runs A* over the map and steps its agent, so its plan
+# follows from the map's analysis (one object for as long as the map is
+# analyzed), the agent's cell and the goal, and it only moves the agent
+def move_towards_reads(state, agent, goal):
+	return (analyze(state.map), state.loc.get(agent), goal)
+
+def move_towards_writes(state, agent, goal):
+	return [('loc', agent)]
+
+
+# tasks whose plans can be remembered in a pyhop.TranspositionTable, with
+# what their methods and operators use
+MEMO_TASKS = {'move_towards': pyhop.Footprint(move_towards_reads, move_towards_writes)}
+
+# tasks a pyhop.SubplanCache replans only when what they read has changed:
+# a waiting rabbit, or a stag with no hunter near it, keeps its plan
+SUBPLAN_TASKS = ('simulate_agent',)
+
+
 def load_methods(pyhop):
 	pyhop.declare_methods('sim_all', simulate_step_forall)
 	pyhop.declare_methods('move_away_from', move_away_up, move_away_down, move_away_left, move_away_right, evade_up, evade_down, evade_left, evade_right)
@@ -261,13 +460,42 @@ def wait_one(state, agent):
 	return state
 
 
-def pick_closest_target(state, agent):
+# the nearest rabbit agent can hunt, as (rabbit, distance). the first one
+# in state.agents wins a tie
+def closest_rabbit(state, agent):
+	best = ('', INFINITY)
+	if GEODESIC:
+		prefetch_targets(state, 'rabbit')
+	for ptarget in state.agents:
+		if hunts(agent, ptarget) and ptarget[1] == 'rabbit' and ptarget not in state.captured and target_distance(state, agent, ptarget) < best[1]:
+			best = (ptarget, target_distance(state, agent, ptarget))
+	return best
+
+
+# the stag nearest to agent and other together, as (stag, distance)
+def closest_stag(state, agent, other):
 	best = ('', INFINITY)
+	if GEODESIC:
+		prefetch_targets(state, 'stag')
 	for ptarget in state.agents:
-		if hunts(agent, ptarget) and ptarget[1] == 'rabbit' and ptarget not in state.captured and distance(state, agent, ptarget) < best[1]:
-			best = (ptarget, distance(state, agent, ptarget))
+		if hunts(agent, ptarget) and ptarget[1] == 'stag' and ptarget not in state.captured:
+			d = target_distance(state, agent, ptarget) + target_distance(state, other, ptarget)
+			if d < best[1]:
+				best = (ptarget, d)
+				if events.enabled:
+					events.emit('coop_candidate', agent, best)
+	return best
+
+
+def pick_closest_target(state, agent):
+	return aim_at_rabbit(state, agent, closest_rabbit(state, agent))
+
+
+# the rest of pick_closest_target, once best = closest_rabbit(...) is known
+def aim_at_rabbit(state, agent, best):
 	if best[1] < 20: # arbitrary distance
-		print('closest target', agent, best)
+		if events.enabled:
+			events.emit('closest_target', agent, best)
 		state.target[agent] = best[0]
 		if agent not in state.goal:
 			state.goal[agent] = {}
@@ -277,9 +505,8 @@ def pick_closest_target(state, agent):
 		# picked a target, hunter is now locked and loaded
 		if agent not in state.ready:
 			state.ready.append(agent)
-		if best[1] == 0:
-			print('****', agent, best[0], '****')
-			print(state.loc)
+		if best[1] == 0 and events.enabled:
+			events.emit('on_target', agent, best[0], state.loc)
 			#sys.exit(1)
 		return state
 	else:
@@ -287,24 +514,25 @@ def pick_closest_target(state, agent):
 
 
 def pick_coop_target(state, agent, other):
-	print('PICK COOP', agent, other)
-	best = ('', INFINITY)
-	for ptarget in state.agents:
-		if hunts(agent, ptarget) and ptarget[1] == 'stag' and ptarget not in state.captured:
-			d = distance(state, agent, ptarget) + distance(state, other, ptarget)
-			if d < best[1]:
-				best = (ptarget, d)
-				print(best)
+	if events.enabled:
+		events.emit('pick_coop', agent, other)
+	return aim_at_stag(state, agent, other, closest_stag(state, agent, other))
+
+
+# the rest of pick_coop_target, once best = closest_stag(...) is known
+def aim_at_stag(state, agent, other, best):
 	if best[1] < 100: # arbitrary distance
 		state.target[agent] = best[0]
-		print('target is', best)
+		if events.enabled:
+			events.emit('coop_target', agent, best)
 		state.goal[agent]['huntWith'] = (agent, best[0], other)
 		# picked a target, hunter is now locked and loaded
 		if agent not in state.ready:
 			state.ready.append(agent)
 		return state
 	else:
-		print('**** failed to pick coop target ****')
+		if events.enabled:
+			events.emit('coop_failed', agent, other)
 		return False
 
 
@@ -350,20 +578,21 @@ def step_down(state, agent):
 #if stag need cooperator
 ### REALLY neeed to break this into separate actions
 def capture_stag(state, hunter, target):
-	print('capturing stag', hunter, target)
-	print('ready', state.ready)
+	if events.enabled:
+		events.emit('capture_stag', hunter, target, state.ready)
 	if target[1] == 'stag' and \
 		state.loc[hunter] == state.loc[target] and \
 		hunter in state.ready and \
 		target not in state.captured:
 		hunters = [hunter]
-		for agent in state.agents:
-			if agent != hunter and hunts(agent, target) and \
-			 state.loc[agent] == state.loc[target] and agent in state.ready:
+		for agent in agents_at(state, state.loc[target], 'hunter'):
+			if agent != hunter and agent in state.ready:
 				hunters.append(agent)
-		print('hunters', hunters)
+		if events.enabled:
+			events.emit('stag_hunters', target, hunters)
 		if len(hunters) > 1:
-			print(hunters, 'caught', target, state.loc[target])
+			if events.enabled:
+				events.emit('caught', hunters, target, state.loc[target])
 			state.captured.append(target)
 			del state.loc[target]
 			score = int(6 / len(hunters))
@@ -382,7 +611,8 @@ def capture_rabbit(state, hunter, target):
 		state.loc[hunter] == state.loc[target] and \
 		hunter in state.ready and \
 		target not in state.captured:
-		print(hunter, state.loc[hunter], 'caught', target, state.loc[target])
+		if events.enabled:
+			events.emit('caught', [hunter], target, state.loc[target])
 		state.captured.append(target)
 		del state.loc[target]
 		state.score[hunter] += 1
@@ -398,3 +628,13 @@ def capture_none(state, hunter, target):
 
 def load_operators(pyhop):
 	pyhop.declare_operators(wait_one, step_right, step_left, step_up, step_down, pick_coop_target, pick_closest_target, capture_stag, capture_rabbit, capture_none)
+
+
+# the staghunt operators and methods, compiled once and shared by planners.
+# operators, if given, replace the ones of the same names
+def load_domain(*operators):
+	planner = pyhop.Pyhop('staghunt')
+	load_operators(planner)
+	load_methods(planner)
+	planner.declare_operators(*operators)
+	return planner.compile()
@@ -1,4 +1,5 @@
-import pickle
+import sys
+import shards
 
 
 def print_map(map, locs):
@@ -117,19 +118,20 @@ def print_stats(stats):
 if __name__ == '__main__':
     print_visuals = True
     stats = { 'goals':{}, 'goalsChanged':{True:0, False:0}}
-    all = pickle.load(open('all.pickle', 'rb'))
-    for i, cond1 in enumerate(all):
-        for j, cond2 in enumerate(cond1):
-            for k, cond3 in enumerate(cond2):
-                print('')
-                print('* Simulations for conditions', i, j, k, '*')
-                for c, (states, plans) in enumerate(cond3):
-                    stats = calc_stats(stats, states)
-                    if print_visuals:
-                        print('- Sim run', i, j, k, c, '-')
-                        print_trace(states, plans)
-                    else:
-                        print(f'(in-simulation {i} {j} {k} {c})')
-                        print_sexpr(states)
+    # all.pickle or a directory of sweep shards
+    path = sys.argv[1] if len(sys.argv) > 1 else 'all.pickle'
+    condition = None
+    for (i, j, k, c), (states, plans) in shards.iter_runs(path):
+        if (i, j, k) != condition:
+            condition = (i, j, k)
+            print('')
+            print('* Simulations for conditions', i, j, k, '*')
+        stats = calc_stats(stats, states)
+        if print_visuals:
+            print('- Sim run', i, j, k, c, '-')
+            print_trace(states, plans)
+        else:
+            print(f'(in-simulation {i} {j} {k} {c})')
+            print_sexpr(states)
                     
     print_stats(stats)
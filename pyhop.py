@@ -15,7 +15,7 @@ Copyright 2013 Dana S. Nau - http://www.cs.umd.edu/~nau
    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
    See the License for the specific language governing permissions and
    limitations under the License.
-   
+Pyhop requires Python 3.3 or later.
 Pyhop should work correctly in both Python 2.7 and Python 3.2.
 For examples of how to use it, see the example files that come with Pyhop.
 
@@ -49,12 +49,78 @@ Pyhop provides the following classes and functions:
   (a list of tasks), starting from an initial state state1, using whatever
   methods and operators you declared previously.
 
+- pyhop_state(state1,tasklist) does the same, but returns the plan together
+  with the state it leads to, so there is no need to apply the plan again.
+
 - In the above call to pyhop, you can add an optional 3rd argument called
   'verbose' that tells pyhop how much debugging printout it should provide:
 - if verbose = 0 (the default), pyhop returns the solution but prints nothing;
 - if verbose = 1, it prints the initial parameters and the answer;
 - if verbose = 2, it also prints a message on each recursive call;
 - if verbose = 3, it also prints info about what it's computing.
+
+- Pyhop('foo', undo=True) creates a planner that applies operators to a
+  single working state instead of a fresh copy per operator. Operators see
+  the state through journal(state,log), which records the old value of
+  each variable, dict item or list they change in an undo log, and the log
+  is rolled back when the planner backtracks, at a cost proportional to
+  the changes rather than to the size of the state. Operators may only
+  change state variables and the containers they hold (up to two levels
+  deep, e.g. state.goal[agent]['hunt']); anything deeper is not journaled.
+  Variables a state's class lists in 'constants' are not journaled at all.
+  The caller's state is restored before pyhop returns.
+
+- Pyhop('foo', iterative=True) creates a planner whose pyhop method uses
+  seek_plan_iterative instead of the recursive seek_plan. It finds the same
+  plans, but keeps its choice points on an explicit stack and shares the
+  tails of its task agenda and partial plan, so the cost of a decomposition
+  grows linearly with the number of tasks and is not bounded by Python's
+  recursion limit. Pass maxdepth=None to pyhop to lift the depth limit.
+
+- Pyhop('foo', memo=TranspositionTable({'bar': ('loc',)})) creates a
+  planner that remembers how it accomplished each 'bar' task. The table
+  maps the task and a fingerprint of the state variables it names (here
+  just foo.loc; None means the whole state) to the steps of the task's
+  first plan and the resulting values of those variables. When the same
+  task comes up in an equivalent state, the remembered steps are spliced
+  into the plan without calling any methods or operators. Only list tasks
+  whose methods and operators read and change nothing else. Fingerprinting
+  whole variables can cost more than planning the task again, so a task
+  may be given a Footprint instead, naming just what it reads and the
+  items it writes. If the planner backtracks into a remembered task, it
+  plans the task as usual to look for another way of accomplishing it. A
+  planner with a memo table always uses seek_plan_iterative.
+
+- Pyhop('foo', stats=PlannerStats()) creates a planner that counts, for
+  each method and operator, how often it is called, succeeds, fails and is
+  backtracked over (it succeeded, but the rest of the plan could not be
+  found), and how much time is spent in it. stats.as_dict() returns the
+  counters, stats.dump(fp) writes them as JSON and stats.print_stats()
+  prints them. One PlannerStats may be shared by many planners.
+
+- domain = foo.compile() freezes foo's operators and methods into a Domain,
+  which also lists, for every task name, the operator and methods to try
+  in the order the planner tries them. Pyhop('bar', domain=domain) creates
+  a planner that uses them without declaring anything. A Domain cannot be
+  changed, so it can be shared by any number of planners, and it can be
+  pickled (by reference to its functions) to send it to other processes.
+
+- A state need not be a State. Any object whose variables are attributes
+  will do, including one with __slots__ instead of a __dict__, as long as
+  its class lists the names of its variables in a 'variables' attribute.
+  state_vars(foo) returns the variables of either kind of state as a dict.
+  Variables may also hold array.array containers, which the undo log
+  journals like lists.
+
+- Pyhop('foo', memo=SubplanCache(['bar'], domain)) creates a planner that
+  replans 'bar' tasks incrementally. While a 'bar' task is planned, its
+  methods and operators see the state through a ReadSet, which records
+  what they ask of each variable (foo.loc[x], x in foo.done, ...) and the
+  answers. When the same task comes up again, its last plan is reused if
+  the state still gives the same answers; otherwise it is planned again.
+  Methods and operators should only read the state through its variables
+  and the dicts and lists they hold. Like a TranspositionTable, the planner
+  does not backtrack into a reused plan.
 """
 
 # Pyhop's planning algorithm is very similar to the one in SHOP and JSHOP
@@ -96,11 +162,37 @@ Pyhop provides the following classes and functions:
 
 
 from __future__ import print_function
-import copy,sys, pprint
+import copy,sys, pprint, json
+from array import array
+from collections import OrderedDict
+from collections.abc import Mapping,MutableSequence
+from types import MappingProxyType
+from time import perf_counter
 
 ############################################################
 # States and goals
 
+def state_vars(state):
+    """
+    The variables of state as a dict: its __dict__ itself, or for a state
+    with __slots__, a new dict of the variables its class lists.
+    """
+    try:
+        return vars(state)
+    except TypeError:
+        return dict([(name,getattr(state,name)) for name in type(state).variables
+                     if hasattr(state,name)])
+
+def _set_vars(state,bindings):
+    """Make bindings the variables of state."""
+    try:
+        d = vars(state)
+    except TypeError:
+        for (name,val) in bindings.items():
+            setattr(state,name,val)
+        return
+    d.clear()
+    d.update(bindings)
 class State():
     """A state is just a collection of variable bindings."""
     def __init__(self, name):
@@ -120,7 +212,7 @@ class Goal():
 def print_state(state,indent=4):
     """Print each variable in state, indented by indent spaces."""
     if state != False:
-        for (name,val) in vars(state).items():
+        for (name,val) in state_vars(state).items():
             if name != '__name__':
                 for x in range(indent): sys.stdout.write(' ')
                 sys.stdout.write(state.__name__ + '.' + name)
@@ -155,16 +247,798 @@ def find_if(cond,seq):
         if cond(x): return x
     return None
 
+############################################################
+# Memo tables
+
+def _freeze(val):
+    """A hashable copy of val, with dicts and lists turned into tuples."""
+    if isinstance(val,dict):
+        items = tuple(val.items())
+        try:
+            hash(items)
+        except TypeError:
+            items = tuple([(k,_freeze(v)) for (k,v) in items])
+        return (dict,items)
+    if isinstance(val,Mapping):
+        return _freeze(dict(val.items()))
+    if isinstance(val,(list,tuple,MutableSequence)):
+        items = tuple(val)
+        try:
+            hash(items)
+        except TypeError:
+            items = tuple([_freeze(v) for v in items])
+        return items
+    if isinstance(val,(set,frozenset)):
+        return frozenset([_freeze(v) for v in val])
+    if isinstance(val,array):
+        return (array,val.typecode,val.tobytes())
+    if isinstance(val,(State,Goal)):
+        return (type(val),fingerprint(val))
+    return val
+
+def fingerprint(state,names=None):
+    """
+    A hashable value that is equal for two states exactly when their
+    variables (or just the variables listed in names) have equal values.
+    """
+    if names is None:
+        names = [name for name in state_vars(state) if name != '__name__']
+    return tuple([(name,_freeze(getattr(state,name,None))) for name in names])
+
+class LRUCache(object):
+    """
+    A dict-like cache holding at most maxsize entries, which evicts the least
+    recently used entry when it is full and counts its hits and misses.
+    """
+
+    def __init__(self,maxsize=4096):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self,key,default=None):
+        """Return the entry for key, or default if there is none."""
+        try:
+            val = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return val
+
+    def put(self,key,val):
+        """Store val under key, evicting the oldest entry if necessary."""
+        self.entries[key] = val
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """Forget all entries and reset the counters."""
+        self.entries.clear()
+        self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """The cache's size and counters, as a dict."""
+        lookups = self.hits + self.misses
+        return {'size':len(self.entries), 'maxsize':self.maxsize,
+                'hits':self.hits, 'misses':self.misses,
+                'evictions':self.evictions,
+                'hit_rate':float(self.hits)/lookups if lookups else 0.0}
+
+class Footprint(object):
+    """
+    What a task uses of the state, for a TranspositionTable that should not
+    fingerprint whole variables: reads(state,*args) returns a hashable value
+    that determines how the task is accomplished, and writes(state,*args)
+    lists the (variable,key) items the task may change, given the state it
+    leaves.
+    """
+    __slots__ = ('reads','writes')
+
+    def __init__(self,reads,writes):
+        self.reads = reads
+        self.writes = writes
+
+class TranspositionTable(LRUCache):
+    """
+    A memo table for Pyhop. tasks maps the name of each task to remember to
+    the names of the state variables its methods and operators use, to None
+    if they may use the whole state, or to a Footprint.
+    """
+
+    tracks_reads = False
+
+    def __init__(self,tasks,maxsize=4096):
+        LRUCache.__init__(self,maxsize)
+        self.tasks = dict(tasks)
+
+    def key(self,state,task):
+        """The key under which the outcome of task in state is stored."""
+        uses = self.tasks[task[0]]
+        if isinstance(uses,Footprint):
+            return (task,uses.reads(state,*task[1:]))
+        return (task,fingerprint(state,uses))
+
+    def record(self,key,result,reads=None):
+        """
+        Store what _search returned for a single task and return the entry:
+        False if the task failed, otherwise (steps,names,post), where steps
+        and names are the plan and expanded task names as Python lists and
+        post holds the resulting state, the values of the task's variables,
+        or for a Footprint, a list of (variable,key,value) items.
+        """
+        if not result:
+            entry = False
+        else:
+            (plan,depth,state) = result
+            task = key[0]
+            uses = self.tasks[task[0]]
+            if uses is None:
+                post = copy.deepcopy(state)
+            elif isinstance(uses,Footprint):
+                post = []
+                for (name,k) in uses.writes(state,*task[1:]):
+                    container = getattr(state,name)
+                    post.append((name,k,copy.deepcopy(container[k]) if k in container else _MISSING))
+            else:
+                post = copy.deepcopy(dict([(name,getattr(state,name)) for name in uses]))
+            entry = (_unlink(plan),_unlink(depth),post)
+        self.put(key,entry)
+        return entry
+
+    def restore(self,entry,state,log=None):
+        """
+        The state that results from applying entry to state. Remembered
+        items are written into state through the undo log if there is one;
+        otherwise, and for remembered variables, the values go into a new
+        state.
+        """
+        post = entry[2]
+        if isinstance(post,list):
+            if log is not None:
+                target = journal(state,log)
+            else:
+                state = target = copy.copy(state)
+                for name in set([name for (name,k,val) in post]):
+                    setattr(state,name,copy.copy(getattr(state,name)))
+            for (name,k,val) in post:
+                container = getattr(target,name)
+                if val is not _MISSING:
+                    container[k] = copy.deepcopy(val)
+                elif k in container:
+                    del container[k]
+            return state
+        if isinstance(post,dict):
+            newstate = copy.copy(state)
+            for (name,val) in post.items():
+                setattr(newstate,name,copy.deepcopy(val))
+            return newstate
+        return copy.deepcopy(post)
+
+############################################################
+# Incremental replanning
+
+_MISSING = object()
+
+# methods of dicts and lists that change them, besides the ones _Watched
+# defines itself
+_CHANGES = frozenset(['pop','popitem','clear','update','setdefault','insert',
+                      'extend','sort','reverse'])
+
+def _answer(val,op,args):
+    """The answer to a question a decomposition asked about a variable."""
+    if val is _MISSING:
+        return _MISSING
+    if op == 'value':
+        return val if isinstance(val,tuple) else _freeze(val)
+    if op == 'item':
+        try:
+            return _freeze(val[args])
+        except (KeyError,IndexError):
+            return _MISSING
+    if op == 'in':
+        return args in val
+    if op == 'len':
+        return len(val)
+    if op == 'iter':
+        return _freeze(list(val))
+    if op == 'attr':
+        return _freeze(getattr(val,args))
+    return _freeze(getattr(val,op)(*args))
+
+def _snapshot(val):
+    """
+    A copy of a variable before it changes, deep enough for what the undo
+    log journals: dicts and lists held by a dict or list are copied too.
+    """
+    if isinstance(val,dict):
+        new = val.copy()
+        for (k,v) in val.items():
+            if type(v) is dict or type(v) is list:
+                dict.__setitem__(new,k,v.copy())
+        return new
+    if isinstance(val,list):
+        return [v.copy() if type(v) is dict or type(v) is list else v for v in val]
+    if isinstance(val,array):
+        return val[:]
+    return copy.deepcopy(val)
+
+class ReadSet(object):
+    """
+    What a decomposition read from its state. queries maps each question
+    (name,op,args) it asked about a state variable to the answer the state
+    it started from gives. Once a variable is about to be changed, a copy
+    of it is kept in before, and later questions are answered from that.
+    wrote tells whether the decomposition may have changed anything.
+    """
+
+    def __init__(self):
+        self.queries = {}
+        self.before = {}
+        self.wrote = False
+
+    def asked(self,name,val,op,args=()):
+        key = (name,op,args)
+        if key not in self.queries:
+            self.queries[key] = _answer(self.before.get(name,val),op,args)
+
+    def changing(self,name,val):
+        if name not in self.before:
+            self.before[name] = val if val is _MISSING else _snapshot(val)
+        self.wrote = True
+
+    def holds(self,state):
+        """True if state gives every question the answer recorded."""
+        for ((name,op,args),answer) in self.queries.items():
+            if _answer(getattr(state,name,_MISSING),op,args) != answer:
+                return False
+        return True
+
+class _Watched(object):
+    """
+    Stands in for a dict or list held by a state variable, and tells a
+    ReadSet what is asked of it and what is about to change.
+    """
+    __slots__ = ('_reads','_name','_val')
+
+    def __init__(self,reads,name,val):
+        self._reads = reads
+        self._name = name
+        self._val = val
+
+    # isinstance() sees the container itself
+    @property
+    def __class__(self):
+        return type(self._val)
+
+    def _asked(self,op,args=()):
+        self._reads.asked(self._name,self._val,op,args)
+
+    def _changing(self):
+        self._reads.changing(self._name,self._val)
+
+    def _inner(self,val):
+        # a container inside this one may be changed behind our back
+        if isinstance(val,(dict,list)):
+            self._changing()
+        return val
+
+    def __getitem__(self,key):
+        self._reads.asked(self._name,self._val,'item',key)
+        val = self._val[key]
+        if type(val) is tuple:
+            return val
+        return self._inner(val)
+
+    def get(self,key,default=None):
+        self._asked('item',key)
+        return self._inner(self._val.get(key,default))
+
+    def __contains__(self,key):
+        self._asked('in',key)
+        return key in self._val
+
+    def __iter__(self):
+        self._asked('iter')
+        return iter(self._val)
+
+    def __len__(self):
+        self._asked('len')
+        return len(self._val)
+
+    def __eq__(self,other):
+        self._asked('iter')
+        return self._val == other
+
+    def __setitem__(self,key,val):
+        self._asked('item',key)
+        self._changing()
+        self._val[key] = val
+
+    def __delitem__(self,key):
+        self._asked('item',key)
+        self._changing()
+        del self._val[key]
+
+    def append(self,val):
+        self._asked('in',val)
+        self._changing()
+        self._val.append(val)
+
+    def remove(self,val):
+        self._asked('in',val)
+        self._changing()
+        self._val.remove(val)
+
+    def __getattr__(self,op):
+        attr = getattr(self._val,op)
+        if not callable(attr):
+            self._asked('attr',op)
+            return attr
+        def call(*args):
+            if op in _CHANGES:
+                self._asked('iter')
+                self._changing()
+            else:
+                self._asked(op,args)
+            return self._inner(attr(*args))
+        return call
+
+    def __repr__(self):
+        return repr(self._val)
+
+    def __deepcopy__(self,memo):
+        return copy.deepcopy(self._val,memo)
+
+    def __reduce__(self):
+        return (copy.copy,(self._val,))
+
+class _WatchedState(object):
+    """Stands in for a state while its reads are tracked by a ReadSet."""
+    __slots__ = ('_state','_reads','_views')
+
+    def __init__(self,state,reads):
+        object.__setattr__(self,'_state',state)
+        object.__setattr__(self,'_reads',reads)
+        object.__setattr__(self,'_views',{})
+
+    @property
+    def __class__(self):
+        return type(self._state)
+
+    def __getattr__(self,name):
+        val = getattr(self._state,name)
+        view = self._views.get(name)
+        if view is not None and view._val is val:
+            return view
+        if type(val) is not tuple and isinstance(val,(Mapping,MutableSequence,list,array)):
+            view = self._views[name] = _Watched(self._reads,name,val)
+            return view
+        self._reads.asked(name,val,'value')
+        return val
+
+    def __setattr__(self,name,val):
+        self._reads.changing(name,getattr(self._state,name,_MISSING))
+        setattr(self._state,name,val)
+
+class SubplanCache(LRUCache):
+    """
+    A memo table for incremental replanning. For each task it lists (by
+    name), it keeps the plan the task last got, together with the ReadSet of
+    its decomposition: every question its methods and operators asked about
+    the state, e.g. which agents stand in a cell, and the answer. The next
+    time the task comes up, the plan is reused if the state still gives the
+    same answers, and the task is planned again if it doesn't. A reused plan
+    is replayed with domain's operators, unless it changed nothing. Failed
+    tasks are not remembered, and tasks whose plans keep going stale are
+    watched less often (see watching), as tracking costs more than it saves
+    for them. stats() adds the number of plans that went stale.
+    """
+    tracks_reads = True
+
+    def __init__(self,tasks,domain,maxsize=4096,backoff=4):
+        LRUCache.__init__(self,maxsize)
+        self.tasks = dict.fromkeys(tasks)
+        self.domain = domain
+        self.backoff = backoff
+        self.stale = 0
+        # task -> times in a row its plan went stale, and steps left
+        # until it is watched again
+        self.streaks = {}
+        self.skips = {}
+
+    def key(self,state,task):
+        """The task itself, after forgetting its plan if state has changed."""
+        entry = self.entries.get(task)
+        if entry is not None:
+            if entry[2].holds(state):
+                self.streaks.pop(task,None)
+            else:
+                del self.entries[task]
+                self.stale += 1
+                n = self.streaks[task] = self.streaks.get(task,0)+1
+                self.skips[task] = min(n,self.backoff)
+        return task
+
+    def watching(self,task):
+        """
+        Whether to track task's reads this time. A task whose plans keep
+        going stale is planned without tracking for one step after the
+        first time, two after the second, and so on up to backoff steps.
+        """
+        skip = self.skips.get(task)
+        if skip:
+            self.skips[task] = skip-1
+            return False
+        return True
+
+    def record(self,key,result,reads=None):
+        """Store the plan result found with reads, and return the entry."""
+        if not result:
+            return False
+        (plan,depth,state) = result
+        entry = (_unlink(plan),_unlink(depth),reads)
+        self.put(key,entry)
+        return entry
+
+    def restore(self,entry,state,log=None):
+        """The state that results from replaying entry's plan in state."""
+        (steps,names,reads) = entry
+        if not reads.wrote:
+            return state
+        if log is None:
+            state = target = copy.deepcopy(state)
+        else:
+            target = journal(state,log)
+        operators = self.domain.operators
+        for (task,n) in steps:
+            operators[task[0]](target,*task[1:])
+        return state
+
+    def stats(self):
+        stats = LRUCache.stats(self)
+        stats['stale'] = self.stale
+        return stats
+
+############################################################
+# Profiling
+
+class PlannerStats(object):
+    """Counters and timers for the methods and operators a planner calls."""
+
+    def __init__(self):
+        # name -> [kind,calls,successes,failures,backtracks,seconds]
+        self.counters = {}
+
+    def record(self,kind,fn,ok,seconds):
+        """Count a call of fn, a 'method' or 'operator', that took seconds."""
+        counter = self.counters.get(fn.__name__)
+        if counter is None:
+            counter = self.counters[fn.__name__] = [kind,0,0,0,0,0.0]
+        counter[1] += 1
+        if ok:
+            counter[2] += 1
+        else:
+            counter[3] += 1
+        counter[5] += seconds
+
+    def backtrack(self,fn):
+        """Count a backtrack over a successful call of fn."""
+        self.counters[fn.__name__][4] += 1
+
+    def clear(self):
+        self.counters.clear()
+
+    def as_dict(self):
+        """The counters, as a dict of dicts keyed by method or operator name."""
+        return dict([(name,{'kind':c[0], 'calls':c[1], 'successes':c[2],
+                            'failures':c[3], 'backtracks':c[4], 'seconds':c[5]})
+                     for (name,c) in self.counters.items()])
+
+    def dump(self,fp):
+        """Write the counters as JSON to fp, a file object or a file name."""
+        if isinstance(fp,str):
+            with open(fp,'w') as f:
+                json.dump(self.as_dict(),f,indent=2,sort_keys=True)
+        else:
+            json.dump(self.as_dict(),fp,indent=2,sort_keys=True)
+
+    def print_stats(self):
+        """Print a table of the counters, most time consuming first."""
+        print('{:<26}{:<10}{:>9}{:>9}{:>9}{:>11}{:>10}'.format(
+            'NAME:','KIND:','CALLS:','OK:','FAILED:','BACKTRACK:','SECONDS:'))
+        for (name,c) in sorted(self.counters.items(),key=lambda item: -item[1][5]):
+            print('{:<26}{:<10}{:>9}{:>9}{:>9}{:>11}{:>10.3f}'.format(name,*c))
+
+############################################################
+# Undo log used when a planner is created with undo=True. Operators see the
+# state through a _JournaledState, and each change they make to a state
+# variable, or to a container it holds (up to two levels deep), is written
+# to the log as it is made: the old value of a dict item, a copy of a list
+# or array before it changes, or the old bindings before a variable is set.
+# rollback undoes the entries newest first, so it costs as much as the
+# changes did, whatever the size of the state.
+
+# kinds of log entries
+_ITEM, _SEQUENCE, _VARS = range(3)
+
+def journal(state,log):
+    """A view of state that writes every change made through it to log."""
+    return _JournaledState(state,log)
+
+def _restore(container,contents):
+    if isinstance(container,(list,array)):
+        container[:] = contents
+    else:
+        container.clear()
+        container.extend(contents)
+
+def rollback(log,mark=0):
+    """Undo every entry in log after position mark, newest first."""
+    while len(log) > mark:
+        entry = log.pop()
+        kind = entry[0]
+        if kind == _ITEM:
+            (_,container,key,old) = entry
+            if old is not _MISSING:
+                container[key] = old
+            elif key in container:
+                del container[key]
+        elif kind == _SEQUENCE:
+            _restore(entry[1],entry[2])
+        else:
+            _set_vars(entry[1],entry[2])
+
+class _Journaled(object):
+    """
+    Stands in for a dict, list or array held by a state variable (or by
+    one of those), and logs what each change is about to overwrite.
+    """
+    __slots__ = ('_log','_val','_depth')
+
+    def __init__(self,log,val,depth=1):
+        self._log = log
+        self._val = val
+        self._depth = depth
+
+    # isinstance() sees the container itself
+    @property
+    def __class__(self):
+        return type(self._val)
+
+    def _item(self,key):
+        self._log.append((_ITEM,self._val,key,self._val.get(key,_MISSING)))
+
+    def _changing(self,key=None):
+        if isinstance(self._val,Mapping):
+            self._item(key)
+        else:
+            val = self._val
+            self._log.append((_SEQUENCE,val,val[:] if isinstance(val,(list,array)) else list(val)))
+
+    def _inner(self,val):
+        if self._depth < 2 and (type(val) is dict or type(val) is list):
+            return _Journaled(self._log,val,self._depth+1)
+        return val
+
+    def __getitem__(self,key):
+        val = self._val[key]
+        if type(val) is tuple:
+            return val
+        return self._inner(val)
+
+    def get(self,key,default=None):
+        return self._inner(self._val.get(key,default))
+
+    def __contains__(self,key):
+        return key in self._val
+
+    def __iter__(self):
+        return iter(self._val)
+
+    def __len__(self):
+        return len(self._val)
+
+    def __eq__(self,other):
+        return self._val == other
+
+    def __ne__(self,other):
+        return self._val != other
+
+    __hash__ = None
+
+    def __setitem__(self,key,val):
+        self._changing(key)
+        self._val[key] = val
+
+    def __delitem__(self,key):
+        self._changing(key)
+        del self._val[key]
+
+    def append(self,val):
+        self._changing()
+        self._val.append(val)
+
+    def remove(self,val):
+        self._changing()
+        self._val.remove(val)
+
+    def pop(self,*args):
+        if isinstance(self._val,Mapping):
+            if args and args[0] in self._val:
+                self._item(args[0])
+        else:
+            self._changing()
+        return self._val.pop(*args)
+
+    def popitem(self):
+        (key,val) = self._val.popitem()
+        self._log.append((_ITEM,self._val,key,val))
+        return (key,val)
+
+    def setdefault(self,key,default=None):
+        if key not in self._val:
+            self._item(key)
+        return self._inner(self._val.setdefault(key,default))
+
+    def update(self,*args,**kwargs):
+        items = dict(*args,**kwargs)
+        for key in items:
+            self._item(key)
+        self._val.update(items)
+
+    def clear(self):
+        if isinstance(self._val,Mapping):
+            for key in list(self._val):
+                self._item(key)
+        else:
+            self._changing()
+        self._val.clear()
+
+    def __getattr__(self,op):
+        attr = getattr(self._val,op)
+        if op in _CHANGES and callable(attr):
+            # insert, extend, sort, reverse and the like
+            def call(*args,**kwargs):
+                self._changing()
+                return attr(*args,**kwargs)
+            return call
+        return attr
+
+    def __repr__(self):
+        return repr(self._val)
+
+    def __deepcopy__(self,memo):
+        return copy.deepcopy(self._val,memo)
+
+    def __reduce__(self):
+        return (copy.copy,(self._val,))
+
+class _JournaledState(object):
+    """
+    Stands in for a state while an operator changes it in place. Variables
+    its class lists in 'constants' are handed out as they are.
+    """
+    __slots__ = ('_state','_log','_views','_constants')
+
+    def __init__(self,state,log):
+        object.__setattr__(self,'_state',state)
+        object.__setattr__(self,'_log',log)
+        object.__setattr__(self,'_views',{})
+        object.__setattr__(self,'_constants',getattr(type(state),'constants',()))
+
+    @property
+    def __class__(self):
+        return type(self._state)
+
+    def __getattr__(self,name):
+        # every change goes through here, so what was handed out stays good
+        # until a variable is set
+        view = self._views.get(name)
+        if view is not None:
+            return view
+        val = getattr(self._state,name)
+        if type(val) is tuple or name in self._constants:
+            view = val
+        elif isinstance(val,(Mapping,MutableSequence,list,array)):
+            view = _Journaled(self._log,val)
+        else:
+            return val
+        self._views[name] = view
+        return view
+
+    def __setattr__(self,name,val):
+        self._log.append((_VARS,self._state,dict(state_vars(self._state))))
+        self._views.clear()
+        setattr(self._state,name,val)
+
+    def __delattr__(self,name):
+        self._log.append((_VARS,self._state,dict(state_vars(self._state))))
+        self._views.clear()
+        delattr(self._state,name)
+
+############################################################
+# Linked lists used by the iterative planner. A list is either None or a
+# pair (head, tail), so extending one never copies what is already there.
+
+def _unlink(items):
+    """Turn a linked list, newest first, into a Python list, oldest first."""
+    result = []
+    while items is not None:
+        result.append(items[0])
+        items = items[1]
+    result.reverse()
+    return result
+
+def _unlink_plan(plan,depth):
+    """
+    Build the plan seek_plan would return from the linked lists kept by
+    _search: each step gets the list of task names expanded before it.
+    """
+    names = _unlink(depth)
+    return [(task,names[:n]) for (task,n) in _unlink(plan)]
+
+############################################################
+# Compiled domains
+
+class Domain(object):
+    """
+    A frozen table of operators and methods. alternatives maps each task name
+    to a tuple of (is_operator,function) pairs: the operator, if there is
+    one, then the methods, in the order they were declared.
+    """
+    __slots__ = ('operators','methods','alternatives')
+
+    def __init__(self,operators,methods):
+        operators = dict(operators)
+        methods = dict([(name,tuple(fns)) for (name,fns) in methods.items()])
+        alternatives = {}
+        for name in list(operators) + list(methods):
+            options = []
+            if name in operators:
+                options.append((True,operators[name]))
+            for method in methods.get(name,()):
+                options.append((False,method))
+            alternatives[name] = tuple(options)
+        object.__setattr__(self,'operators',MappingProxyType(operators))
+        object.__setattr__(self,'methods',MappingProxyType(methods))
+        object.__setattr__(self,'alternatives',MappingProxyType(alternatives))
+
+    def __setattr__(self,name,val):
+        raise AttributeError('a Domain cannot be changed')
+
+    def __reduce__(self):
+        return (Domain,(dict(self.operators),dict(self.methods)))
+
 ############################################################
 # instance of planner
 
 class Pyhop(object):
     """Encapsulating an instance of pyhop, so we don't have a single global one"""
 
-    def __init__(self,name):
+    def __init__(self,name,undo=False,iterative=False,memo=None,stats=None,domain=None):
         self.__name__ = name
-        self.operators = {}
-        self.methods = {}
+        self.domain = domain
+        if domain is None:
+            self.operators = {}
+            self.methods = {}
+        else:
+            self.operators = domain.operators
+            self.methods = domain.methods
+        self.undo = undo
+        self.iterative = iterative
+        self.memo = memo
+        self.stats = stats
+        # the Domain compile() built from the declarations, until they change
+        self._compiled = None
 
     ############################################################
     # Commands to tell Pyhop what the operators and methods are
@@ -174,6 +1048,8 @@ class Pyhop(object):
         Call this after defining the operators, to tell Pyhop what they are. 
         op_list must be a list of functions, not strings.
         """
+        self._check_not_frozen()
+        self._compiled = None
         self.operators.update({op.__name__:op for op in op_list})
         return self.operators
 
@@ -183,9 +1059,27 @@ class Pyhop(object):
         task_name must be a string.
         method_list must be a list of functions, not strings.
         """
+        self._check_not_frozen()
+        self._compiled = None
         self.methods.update({task_name:list(method_list)})
         return self.methods[task_name]
 
+    def _check_not_frozen(self):
+        if self.domain is not None:
+            raise TypeError('planner {} uses a compiled domain, which cannot be changed'.format(self.__name__))
+
+    def compile(self):
+        """
+        Return a Domain holding the operators and methods declared so far.
+        It is built once and kept until declare_operators or declare_methods
+        is called again.
+        """
+        if self.domain is not None:
+            return self.domain
+        if self._compiled is None:
+            self._compiled = Domain(self.operators,self.methods)
+        return self._compiled
+
     ############################################################
     # Commands to find out what the operators and methods are
 
@@ -208,16 +1102,50 @@ class Pyhop(object):
         If successful, return the plan. Otherwise return False.
         """
         if verbose>0: print('** pyhop, verbose={}: **\n   state = {}\n   tasks = {}'.format(verbose, state.__name__, tasks))
-        result = self.seek_plan(state,tasks,[],[],verbose)
+        log = [] if self.undo else None
+        try:
+            if self.iterative or self.memo is not None:
+                result = self.seek_plan_iterative(state,tasks,verbose,maxdepth,log)
+            else:
+                result = self.seek_plan(state,tasks,[],[],verbose,log=log)
+        finally:
+            if log: rollback(log)
         if verbose>0: print('** result =',result,'\n')
         return result
 
-    def seek_plan(self,state,tasks,plan,depth,verbose=0,maxdepth=100):
+    def pyhop_state(self,state,tasks,verbose=0,maxdepth=100):
+        """
+        Same as pyhop, but return a pair (plan,newstate), where newstate is
+        the state the plan leads to, as the planner computed it on the way,
+        or (result,None) if no plan was found. state itself is unchanged
+        and newstate shares nothing with it.
+        """
+        if verbose>0: print('** pyhop_state, verbose={}: **\n   state = {}\n   tasks = {}'.format(verbose, state.__name__, tasks))
+        log = [] if self.undo else None
+        try:
+            result = self._search(state,tasks,verbose,maxdepth,log)
+            if result:
+                newstate = result[2]
+                # operators applied to copies leave a fresh state, anything
+                # else may still share containers with state
+                if log is not None or self.memo is not None or newstate is state:
+                    newstate = copy.deepcopy(newstate)
+        finally:
+            if log: rollback(log)
+        if not result:
+            if verbose>0: print('** result =',result,'\n')
+            return (result,None)
+        plan = _unlink_plan(result[0],result[1])
+        if verbose>0: print('** result =',plan,'\n')
+        return (plan,newstate)
+
+    def seek_plan(self,state,tasks,plan,depth,verbose=0,maxdepth=100,log=None):
         """
         Workhorse for pyhop. state and tasks are as in pyhop.
         - plan is the current partial plan.
         - depth is the recursion depth, for use in debugging
         - verbose is whether to print debugging messages
+        - log is the undo log when planning in place, None to copy states
         """
         if verbose>1: print('depth {} tasks {}'.format(len(depth),tasks))
         if len(depth) > maxdepth:
@@ -231,25 +1159,161 @@ class Pyhop(object):
         if task1[0] in self.operators:
             if verbose>2: print('depth {} action {}'.format(len(depth),task1))
             operator = self.operators[task1[0]]
-            newstate = operator(copy.deepcopy(state),*task1[1:])
+            if self.stats is not None: start = perf_counter()
+            if log is None:
+                newstate = operator(copy.deepcopy(state),*task1[1:])
+            else:
+                mark = len(log)
+                view = journal(state,log)
+                newstate = operator(view,*task1[1:])
+                if newstate is view: newstate = state
+            if self.stats is not None: self.stats.record('operator',operator,newstate,perf_counter()-start)
             if verbose>2:
                 print('depth {} new state:'.format(len(depth)))
                 print_state(newstate)
             if newstate:
-                solution = self.seek_plan(newstate,tasks[1:],plan+[(task1,depth)],depth+[task1[0]],verbose)
+                solution = self.seek_plan(newstate,tasks[1:],plan+[(task1,depth)],depth+[task1[0]],verbose,log=log)
                 if solution != False:
                     return solution
+                if self.stats is not None: self.stats.backtrack(operator)
+            if log is not None: rollback(log,mark)
         if task1[0] in self.methods:
             if verbose>2: print('depth {} method instance {}'.format(len(depth),task1))
             relevant = self.methods[task1[0]]
             for method in relevant:
+                if self.stats is not None: start = perf_counter()
                 subtasks = method(state,*task1[1:])
+                if self.stats is not None: self.stats.record('method',method,subtasks != False,perf_counter()-start)
                 # Can't just say "if subtasks:", because that's wrong if subtasks == []
                 if verbose>2:
                     print('depth {} new tasks: {}'.format(len(depth),subtasks))
                 if subtasks != False:
-                    solution = self.seek_plan(state,subtasks+tasks[1:],plan,depth+[task1[0]],verbose)
+                    solution = self.seek_plan(state,subtasks+tasks[1:],plan,depth+[task1[0]],verbose,log=log)
                     if solution != False:
                         return solution
+                    if self.stats is not None: self.stats.backtrack(method)
         if verbose>2: print('depth {} returns failure'.format(len(depth)))
         return False
+
+    def seek_plan_iterative(self,state,tasks,verbose=0,maxdepth=100,log=None):
+        """
+        Same as seek_plan(state,tasks,[],[],verbose,maxdepth,log), but without
+        recursion. maxdepth=None means there is no depth limit.
+        """
+        result = self._search(state,tasks,verbose,maxdepth,log)
+        if not result:
+            return result
+        return _unlink_plan(result[0],result[1])
+
+    def _search(self,state,tasks,verbose=0,maxdepth=100,log=None,remember=True,reads=None):
+        """
+        Workhorse for seek_plan_iterative. If successful, return a triple
+        (plan,depth,state): plan is a linked list of (task,n) pairs, where n
+        is the number of tasks expanded before the step, depth is a linked
+        list of the names of all expanded tasks, and state is the final
+        state. Return False on failure, or None if maxdepth was exceeded.
+        If remember is False, the first task is expanded even if the memo
+        table could supply its plan. If reads is a ReadSet, methods and
+        operators see the state through it, and the memo table is not used.
+        """
+        agenda = None
+        for task in reversed(tasks):
+            agenda = (task,agenda)
+        plan = depth = None
+        ndepth = 0
+        # each choice point is [state,task,rest of agenda,plan,depth,ndepth,
+        # alternatives tried,undo log length,function that last succeeded]
+        choices = []
+        alternatives = self.compile().alternatives
+        memo = self.memo
+        stats = self.stats
+        while True:
+            if verbose>1: print('depth {} tasks {}'.format(ndepth,_unlink(agenda)[::-1]))
+            if maxdepth is not None and ndepth > maxdepth:
+                print('WARNING: Depth limit reached, returning no plan')
+                return None
+            if agenda is None:
+                if verbose>2: print('depth {} returns plan {}'.format(ndepth,_unlink_plan(plan,depth)))
+                return (plan,depth,state)
+            task1,rest = agenda
+            if verbose>1: print('next task', task1)
+            remembered = memo is not None and task1[0] in memo.tasks and (remember or ndepth) and reads is None
+            if remembered:
+                key = memo.key(state,task1)
+                entry = memo.get(key)
+                # a task a SubplanCache isn't watching is planned as usual
+                remembered = entry is not None or not memo.tracks_reads or memo.watching(key)
+            if remembered:
+                # the task's alternatives are still tried if the planner
+                # backtracks into it
+                choice = [state,task1,rest,plan,depth,ndepth,0,0 if log is None else len(log),None]
+                if entry is None:
+                    watch = ReadSet() if memo.tracks_reads else None
+                    result = self._search(state,[task1],verbose,None if maxdepth is None else maxdepth-ndepth,log,False,watch)
+                    if result is None:
+                        return None
+                    entry = memo.record(key,result,watch)
+                    if entry: state = result[2]
+                elif entry:
+                    if verbose>2: print('depth {} remembered {}'.format(ndepth,task1))
+                    state = memo.restore(entry,state,log)
+                if entry:
+                    choices.append(choice)
+                    (steps,names,post) = entry
+                    for (task,n) in steps:
+                        plan = ((task,ndepth+n),plan)
+                    for name in names:
+                        depth = (name,depth)
+                    ndepth += len(names)
+                    agenda = rest
+                    continue
+            else:
+                choices.append([state,task1,rest,plan,depth,ndepth,0,0 if log is None else len(log),None])
+            while True:
+                if not choices:
+                    return False
+                choice = choices[-1]
+                state,task1,rest,plan,depth,ndepth,tried,mark,succeeded = choice
+                if log is not None: rollback(log,mark)
+                if succeeded is not None:
+                    if stats is not None: stats.backtrack(succeeded)
+                    choice[8] = None
+                options = alternatives.get(task1[0],())
+                if tried == len(options):
+                    if verbose>2: print('depth {} returns failure'.format(ndepth))
+                    choices.pop()
+                    continue
+                choice[6] = tried+1
+                is_operator,fn = options[tried]
+                if stats is not None: start = perf_counter()
+                if is_operator:
+                    if verbose>2: print('depth {} action {}'.format(ndepth,task1))
+                    if log is None:
+                        target = view = copy.deepcopy(state)
+                    else:
+                        target = state
+                        view = journal(state,log)
+                    if reads is not None:
+                        view = _WatchedState(view,reads)
+                    newstate = fn(view,*task1[1:])
+                    if newstate is view: newstate = target
+                    if stats is not None: stats.record('operator',fn,newstate,perf_counter()-start)
+                    if newstate:
+                        choice[8] = fn
+                        state = newstate
+                        agenda = rest
+                        plan = ((task1,ndepth),plan)
+                        break
+                else:
+                    if verbose>2: print('depth {} method instance {}'.format(ndepth,task1))
+                    subtasks = fn(state if reads is None else _WatchedState(state,reads),*task1[1:])
+                    if stats is not None: stats.record('method',fn,subtasks != False,perf_counter()-start)
+                    if verbose>2: print('depth {} new tasks: {}'.format(ndepth,subtasks))
+                    if subtasks != False:
+                        choice[8] = fn
+                        agenda = rest
+                        for task in reversed(subtasks):
+                            agenda = (task,agenda)
+                        break
+            depth = (task1[0],depth)
+            ndepth += 1
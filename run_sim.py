@@ -2,11 +2,42 @@ import pyhop
 from copy import deepcopy
 import random
 import pickle
+import functools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import models.staghunt_htn
-import print_trace as pt
+import coalitions
+import events
+import shards
+import os
 
 MENTAL_SIM_LEN = 5
 
+# set to a pyhop.PlannerStats() to profile every planner run_sim builds, e.g.
+# PLANNER_STATS = pyhop.PlannerStats(); run_all(); PLANNER_STATS.dump('stats.json')
+PLANNER_STATS = None
+
+# the model and the simulator report what they do through events, which are
+# off by default, e.g. events.enable(events.PrintSink()) to watch a run
+
+# set to a pyhop.LRUCache(maxsize) to let decide reuse the outcome of a goal
+# set sim whenever the same position comes round again, across steps, runs
+# and hunters. forked sweep workers each carry on with their own copy
+MENTAL_SIM_CACHE = None
+
+# set to True to replan incrementally: each run keeps a pyhop.SubplanCache of
+# every agent's last simulate_agent plan, and only agents whose plans read
+# something that has changed since are planned again
+INCREMENTAL = False
+
+# set to True to let the goal set sims of a decide share a
+# pyhop.TranspositionTable of move_towards plans. A* answers are cached per
+# map already, so on the stock maps this saves no time
+SHARED_MOVES = False
+
+# built once, shared by every planner (and picklable for worker processes)
+DOMAIN = models.staghunt_htn.load_domain()
+
 # maps = [0,1,2,3,4,5,6,7,8,9,10]
 #
 # maps[0] = [[0, 0, 0, 0, 0, 0, 0],
@@ -265,72 +296,166 @@ def assignGoals(state, c):
 def pickMap(state, condition):
     #c = random.randint(0, 4)
     #state.map = maps[c]
-    state.map = maps[condition[0]][condition[1]]
+    state.map = models.staghunt_htn.intern_map(maps[condition[0]][condition[1]])
 
 def setupAgents(state, condition):
-    state.agents = [('r1', 'rabbit'), ('r2', 'rabbit')]
+    agents = [('r1', 'rabbit'), ('r2', 'rabbit')]
     for i in range(0,condition[2]+1):
-        state.agents.append((f's{i+1}', 'stag'))
-    state.agents.extend([('h1', 'hunter'), ('h2', 'hunter'), ('h3', 'hunter')])
+        agents.append((f's{i+1}', 'stag'))
+    agents.extend([('h1', 'hunter'), ('h2', 'hunter'), ('h3', 'hunter')])
+    state.agents = tuple(agents)
 
-    state.loc = {}
+    state.loc = models.staghunt_htn.LocIndex()
     for agent in state.agents:
-        print(agent)
         done = False
         while not done:
             x = random.randint(0,len(state.map)-1)
             y = random.randint(0,len(state.map[0])-1)
-            print(x,y)
+            if events.enabled:
+                events.emit('place_try', agent, (x,y))
             if state.map[x][y] > 0:
-                done = True
-                for other in state.loc:
-                    if state.loc[other] == (x,y):
-                        done = False
-                        break
+                done = (x,y) not in state.loc.cells
                 if done:
                     state.loc[agent] = (x,y)
 
-def run_all():
-    all_sims = [[[None for i in range(3)] for j in range(3)] for k in range(3)]
+# every run of the sweep as (condition, replicate), in all_sims order
+def sweep_jobs():
+    jobs = []
     for i in range(0, 3): # map size
         for j in range(0, 3): # map density
             for k in range(0, 3):
-                runs_for_cond = []
                 for c in range(0, 30):
-                    states_plans = run_one((i,j,k))
-                    runs_for_cond.append(states_plans)
-                all_sims[i][j][k] = runs_for_cond
+                    jobs.append(((i,j,k), c))
+    return jobs
+
+# with a seed the runs are spread over a pool of worker processes, each run
+# seeded from the sweep seed and its place in the sweep, so the results don't
+# depend on the number of workers or the order they finish in.
+# with a directory every run is saved to its own shard there as soon as it
+# is done, instead of all.pickle at the end, and the runs already saved are
+# skipped. read the runs back with shards.iter_runs(directory)
+def run_all(workers=None, seed=None, directory=None):
+    jobs = sweep_jobs()
+    if directory is not None:
+        run_shards(jobs, directory, seed, workers)
+        return
+    if seed is None:
+        runs = (run_one(condition) for condition, _ in jobs)
+    else:
+        runs = iter(run_sweep(jobs, seed, workers))
+    all_sims = [[[None for i in range(3)] for j in range(3)] for k in range(3)]
+    for i in range(0, 3):
+        for j in range(0, 3):
+            for k in range(0, 3):
+                all_sims[i][j][k] = [next(runs) for c in range(0, 30)]
     pickle.dump(all_sims, open('all.pickle', 'wb'))
 
-
-
-def decide(state):
-    # sim each set of goals
+# run the jobs in worker processes, the results in the order of the jobs.
+# even a single worker runs out of process, so every run is pickled on its
+# own and shares nothing with the others, whatever the pool size
+def run_sweep(jobs, seed, workers=None):
+    with ProcessPoolExecutor(workers) as pool:
+        return list(pool.map(run_seeded, [seed]*len(jobs), *zip(*jobs)))
+
+def run_seeded(seed, condition, c):
+    random.seed(f'{seed}:{condition[0]}:{condition[1]}:{condition[2]}:{c}')
+    return run_one(condition)
+
+# run the jobs that have no shard in the directory yet, saving each one as
+# it finishes. workers write their own shards, so no run is held in memory
+# any longer than it takes to save it
+def run_shards(jobs, directory, seed=None, workers=None):
+    os.makedirs(directory, exist_ok=True)
+    done = set(shards.completed(directory))
+    todo = [job for job in jobs if job not in done]
+    if seed is None:
+        for condition, c in todo:
+            shards.write_shard(directory, condition, c, run_one(condition))
+    elif todo:
+        with ProcessPoolExecutor(workers) as pool:
+            for _ in pool.map(run_shard, [directory]*len(todo), [seed]*len(todo), *zip(*todo)):
+                pass
+
+def run_shard(directory, seed, condition, c):
+    shards.write_shard(directory, condition, c, run_seeded(seed, condition, c))
+
+
+
+# the executor, if given, runs the goal set sims concurrently, e.g. a
+# concurrent.futures.ProcessPoolExecutor kept open for the whole run. a
+# thread pool works too, as the map analyses the sims share are locked.
+# the cache (MENTAL_SIM_CACHE by default) holds the outcomes of earlier sims.
+# the sims are deterministic, so the goals picked are the same either way.
+# the goal sets are the coalition structures of the hunters, however many
+# there are, except the one with all of them together, which isn't picked
+def decide(state, executor=None, cache=None):
+    if cache is None:
+        cache = MENTAL_SIM_CACHE
+    # sim each set of goals, keeping the goals and the final scores
     sims = []
-    for c in range(5):
-        print('goal set', c)
-        sims.append(deepcopy(state))
-        # reset scores for each mental sim
-        for agent in sims[c].score:
-            sims[c].score[agent] = 0
-        assignGoals(sims[c], c)
-        print('**** goals ****', sims[c].goal)
-        states,_ = simulate_state(sims[c], MENTAL_SIM_LEN)
-        sims[c] = states
-        print('**** scores ****', sims[c][-1].score)
+    todo = []
+    memo = None
+    if executor is None and SHARED_MOVES:
+        # the goal sets often lead to the same moves, so share them between sims
+        memo = pyhop.TranspositionTable(models.staghunt_htn.MEMO_TASKS)
+    for i, c in coalitions.goal_sets(coalitions.hunters(state), grand=False):
+        sims.append(None)
+        if cache is not None:
+            key = mental_sim_key(state, c)
+            hit = cache.get(key)
+            if hit is not None:
+                sims[i] = deepcopy(hit)
+                continue
+        if executor is None:
+            sims[i] = mental_sim(state, c, memo)
+            if cache is not None:
+                cache.put(key, deepcopy(sims[i]))
+        else:
+            todo.append((i, c))
+    if todo:
+        done = executor.map(mental_sim, [state]*len(todo), [c for _,c in todo])
+        for (i, c), sim in zip(todo, done):
+            sims[i] = sim
+            if cache is not None:
+                cache.put(mental_sim_key(state, c), deepcopy(sim))
     # reset goals
     state.goal = {}
     # for each agent, pick best result
     for agent in state.agents:
         if agent[1] == 'hunter':
-            s = argmax(range(4), lambda x: sims[x][-1].score[agent])
-            print('argmax', s, agent)
-            print('-sims score', sims[s][-1].score)
-            print('-sims goal', sims[s][0].goal)
-            if agent in sims[s][0].goal:
-                print('--assigning goal', sims[s][0].goal[agent])
-                state.goal[agent] = sims[s][0].goal[agent]
-            state.assumes[agent] = sims[s][0].goal
+            s = argmax(range(len(sims)), lambda x: sims[x][1][agent])
+            if events.enabled:
+                events.emit('argmax', agent, s, sims[s][1], sims[s][0])
+            if agent in sims[s][0]:
+                if events.enabled:
+                    events.emit('assign_goal', agent, sims[s][0][agent])
+                state.goal[agent] = sims[s][0][agent]
+            state.assumes[agent] = sims[s][0]
+
+# everything a goal set sim depends on. the sim replaces the goals and resets
+# the scores, and only reads the targets it has just picked
+def mental_sim_key(state, c):
+    return (c, models.staghunt_htn.GEODESIC, tuple(map(tuple, state.map)), tuple(state.agents),
+            tuple(sorted(state.loc.items())), tuple(state.captured), tuple(state.ready),
+            tuple(sorted(state.score)))
+
+# sim goal set c, a coalition structure of the hunters (or one of
+# assignGoals' numbers), from state, returns the goals and the final scores
+def mental_sim(state, c, memo=None):
+    sim = deepcopy(state)
+    # reset scores for each mental sim
+    for agent in sim.score:
+        sim.score[agent] = 0
+    if isinstance(c, int):
+        assignGoals(sim, c)
+    else:
+        sim.goal = coalitions.goals(c)
+    if events.enabled:
+        events.emit('goal_set', c, sim.goal)
+    states,_ = simulate_state(sim, MENTAL_SIM_LEN, memo=memo)
+    if events.enabled:
+        events.emit('goal_set_score', c, states[-1].score)
+    return sim.goal, states[-1].score
 
 
 def argmax(args, fn):
@@ -343,32 +468,77 @@ def argmax(args, fn):
             max_arg = arg
     return max_arg
 
-def run_one(condition):
+def run_one(condition, executor=None, cache=None):
     state = get_start_state_rand(condition)
-    return simulate_state(state, 3, decide)
-
-def simulate_state(state, sim_steps, goal_manager = None):
-    planner = pyhop.Pyhop('hippity-hop')
-    models.staghunt_htn.load_operators(planner)
-    models.staghunt_htn.load_methods(planner)
-    states = [state]
-    plans = []
-    pt.print_map(state.map, state.loc)
-    for i in range(0, sim_steps):
+    if executor is None and cache is None:
+        return simulate_state(state, 3, decide)
+    return simulate_state(state, 3, functools.partial(decide, executor=executor, cache=cache))
+
+def simulate_state(state, sim_steps, goal_manager = None, memo = None):
+    history = History()
+    for _ in iter_simulate(state, sim_steps, goal_manager, memo, history):
+        pass
+    return history.states, history.plans
+
+# simulate_state as a stream: yields (step, state, plan) for each step, the
+# state once its goals are decided and the plan made from it, and finally
+# (sim_steps, state, None) for the state the last plan leads to. with
+# sim_steps None it runs until the caller stops. a History, if given, keeps
+# as much of the stream as it is told to
+def iter_simulate(state, sim_steps=None, goal_manager = None, memo = None, history = None):
+    # a models.compact state plans with its own id-based domain
+    domain = getattr(state, 'domain', DOMAIN)
+    if memo is None and INCREMENTAL:
+        memo = pyhop.SubplanCache(models.staghunt_htn.SUBPLAN_TASKS, domain)
+    planner = pyhop.Pyhop('hippity-hop', undo=True, iterative=True, domain=domain, memo=memo, stats=PLANNER_STATS)
+    if events.enabled:
+        events.emit('map', state.map, state.loc)
+    i = 0
+    while sim_steps is None or i < sim_steps:
         # decisions, decisions.  to decide or not to decide
         if goal_manager:
             goal_manager(state) # side-effects goals
-        print('* goals *', state.goal)
-        plan = planner.pyhop(state, [('sim_all',)], verbose=0)
-        plans.append(plan)
-        pt.print_plan(plan)
-        state = deepcopy(state)
-        for action in plan:
-            fn = planner.operators[action[0][0]]
-            fn(state, *action[0][1:])
-        pt.print_map(state.map, state.loc)
-        states.append(state)
-    return states, plans
+        if events.enabled:
+            events.emit('goals', state.goal)
+        # the planner hands back the state its plan leads to. a step expands
+        # a couple of tasks per agent, so there is no depth limit
+        plan, newstate = planner.pyhop_state(state, [('sim_all',)], verbose=0, maxdepth=None)
+        if newstate is None:
+            raise RuntimeError('no plan for step %d of the run' % i)
+        if events.enabled:
+            events.emit('plan', plan)
+        if history is not None:
+            history.add(i, state, plan)
+        yield i, state, plan
+        state = newstate
+        if events.enabled:
+            events.emit('map', state.map, state.loc)
+        i += 1
+    if history is not None:
+        history.add(i, state, None)
+    yield i, state, None
+
+# what a streamed run keeps: the (step, state, plan) of every k-th step, and
+# of those only the last window of them. History() keeps everything,
+# History(every=10) every tenth step and History(window=100) the last 100
+# steps. to keep nothing, pass no History at all
+class History:
+    def __init__(self, every=1, window=None):
+        self.every = every
+        self.entries = deque(maxlen=window)
+
+    def add(self, step, state, plan):
+        if step % self.every == 0:
+            self.entries.append((step, state, plan))
+
+    @property
+    def states(self):
+        return [state for _, state, _ in self.entries]
+
+    # the plans made from the kept states, the final state has none
+    @property
+    def plans(self):
+        return [plan for _, _, plan in self.entries if plan is not None]
 
 if __name__ == '__main__':
     run_all()
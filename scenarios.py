@@ -0,0 +1,155 @@
+import functools
+from collections import deque
+import numpy as np
+import models.staghunt_htn
+
+# generated scenarios for benchmarks and large sweeps. a condition (i, j, k)
+# picks the map size SIZES[i] and wall density DENSITIES[j] like pickMap's
+# hand-drawn maps do, and k+1 stags like setupAgents. each (i, j) has one map
+# per seed, shared by all the runs of the condition, and each run c places
+# its agents anew. everything is drawn from NumPy generators seeded with
+# (seed, i, j, k) and hashes of c, so a scenario doesn't depend on what ran
+# before it
+#
+#   state = scenarios.start_state((3, 2, 1), seed=7, c=12)
+#   states = scenarios.start_states((5, 1, 0), seed=7, count=10000)
+
+# interior width and height of the maps, walls not counted
+SIZES = (5, 7, 9, 17, 33, 65)
+# fraction of the interior that is wall, as in the x1, x3 and x5 maps
+DENSITIES = (0.1, 0.3, 0.5)
+STAGS = (1, 2, 3)
+
+
+def rng(*key):
+    return np.random.default_rng(np.random.SeedSequence(key))
+
+
+# a width x height map with a wall all around it and density of the
+# interior walled off, whose open cells are all connected. that many random
+# walls are dropped in, the largest open region is kept, and walls next to it are
+# opened again at random until there are just enough
+def generate_map(width, height, density, gen):
+    interior = width * height
+    walls = int(round(density * interior))
+    if walls >= interior:
+        raise ValueError('a map needs at least one open cell')
+    inside = np.ones(interior, np.int8)
+    inside[gen.choice(interior, walls, replace=False)] = 0
+    grid = np.zeros((width+2, height+2), np.int8)
+    grid[1:-1, 1:-1] = inside.reshape(width, height)
+    grid = largest_region(grid)
+    while interior - int(grid.sum()) > walls:
+        # walls inside the border next to the open region
+        near = np.zeros_like(grid, bool)
+        near[1:-1, 1:-1] = (grid[:-2, 1:-1] | grid[2:, 1:-1] | grid[1:-1, :-2] | grid[1:-1, 2:]) > 0
+        candidates = np.flatnonzero(near & (grid == 0))
+        n = min(interior - int(grid.sum()) - walls, len(candidates))
+        grid.flat[gen.choice(candidates, n, replace=False)] = 1
+    return grid
+
+
+# grid with every open cell outside its largest open region walled off
+def largest_region(grid):
+    labels = np.zeros(grid.shape, np.int32)
+    width, height = grid.shape
+    sizes = [0]
+    for start in zip(*np.nonzero(grid)):
+        if labels[start]:
+            continue
+        label = len(sizes)
+        labels[start] = label
+        queue = deque([start])
+        size = 0
+        while queue:
+            x, y = queue.popleft()
+            size += 1
+            for nx, ny in ((x+1, y), (x-1, y), (x, y+1), (x, y-1)):
+                if 0 <= nx < width and 0 <= ny < height and grid[nx, ny] and not labels[nx, ny]:
+                    labels[nx, ny] = label
+                    queue.append((nx, ny))
+        sizes.append(size)
+    return (labels == int(np.argmax(sizes))).astype(np.int8)
+
+
+# the map of condition (i, j, ...) for a seed, as an interned state.map
+@functools.lru_cache(maxsize=None)
+def pick_map(i, j, seed=0):
+    grid = generate_map(SIZES[i], SIZES[i], DENSITIES[j], rng(seed, i, j))
+    return models.staghunt_htn.intern_map(grid.tolist())
+
+
+def make_agents(rabbits=2, stags=1, hunters=3):
+    agents = [(f'r{n+1}', 'rabbit') for n in range(rabbits)]
+    agents.extend((f's{n+1}', 'stag') for n in range(stags))
+    agents.extend((f'h{n+1}', 'hunter') for n in range(hunters))
+    return tuple(agents)
+
+
+# 64-bit hashes of the counters, splitmix64's output function
+def mix(x):
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+# (len(runs), n, 2) cells for n agents in each of the runs on grid, all
+# open and no two in a run the same. every run draws cells uniformly at
+# random and keeps the first n different ones, like setupAgents' rejection
+# sampling, but for all the runs at once. the draws of a run are hashes of
+# key, the run and the draw, so they don't depend on the other runs
+def place(grid, n, key, runs):
+    cells = np.flatnonzero(np.asarray(grid).ravel() > 0)
+    if n > len(cells):
+        raise ValueError('%d agents need more than the %d open cells of the map' % (n, len(cells)))
+    runs = np.asarray(runs, np.uint64)
+    picked = np.zeros((len(runs), n), np.intp)
+    todo = np.arange(len(runs))
+    draws = 2 * n
+    while len(todo) and n:
+        counters = (runs[todo, None] << np.uint64(32)) + np.arange(draws, dtype=np.uint64)
+        drawn = (mix(np.uint64(key) + counters * np.uint64(0x9E3779B97F4A7C15)) % np.uint64(len(cells))).astype(np.intp)
+        # which draws are the first of their cell in the run
+        order = np.argsort(drawn, axis=1, kind='stable')
+        ordered = np.take_along_axis(drawn, order, axis=1)
+        first = np.ones(drawn.shape, bool)
+        first[:, 1:] = ordered[:, 1:] != ordered[:, :-1]
+        new = np.empty_like(first)
+        np.put_along_axis(new, order, first, axis=1)
+        count = new.cumsum(axis=1)
+        done = count[:, -1] >= n
+        keep = new[done] & (count[done] <= n)
+        picked[todo[done]] = cells[drawn[done][keep].reshape(-1, n)]
+        # runs short of n different cells draw again, twice as many
+        todo = todo[~done]
+        draws *= 2
+    return np.stack(np.divmod(picked, np.shape(grid)[1]), axis=-1)
+
+
+def new_state(grid, agents, cells):
+    state = models.staghunt_htn.get_start_state()
+    state.map = grid
+    state.agents = agents
+    state.loc = models.staghunt_htn.LocIndex(zip(agents, map(tuple, cells.tolist())))
+    state.score = dict((agent, 0) for agent in agents if agent[1] == 'hunter')
+    return state
+
+
+# the start state of run c of a condition, with no goals set
+def start_state(condition, seed=0, c=0, rabbits=2, hunters=3):
+    return start_states(condition, seed, 1, rabbits, hunters, c)[0]
+
+
+# the start states of runs first to first+count-1 of a condition, placed
+# in one go. run c comes out the same however it is asked for
+def start_states(condition, seed=0, count=1, rabbits=2, hunters=3, first=0):
+    i, j, k = condition
+    grid = pick_map(i, j, seed)
+    agents = make_agents(rabbits, STAGS[k], hunters)
+    key = rng(seed, i, j, k).integers(2**63)
+    return [new_state(grid, agents, cells) for cells in place(grid, len(agents), key, range(first, first+count))]
+
+
+# every condition of the grid
+def conditions():
+    return [(i, j, k) for i in range(len(SIZES)) for j in range(len(DENSITIES)) for k in range(len(STAGS))]
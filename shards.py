@@ -0,0 +1,54 @@
+import os
+import pickle
+from trajectory import Trajectory
+
+# a sweep saved run by run. every finished run, the (states, plans) of
+# all_sims[i][j][k][c], goes to its own shard file sim-i-j-k-c.pickle in the
+# sweep directory. shards are written to a temporary file and renamed into
+# place, so a crash never leaves half a shard behind, and a restarted sweep
+# can skip every run that already has one. runs are stored as Trajectory
+# action logs and read back as (trajectory, plans), the trajectory standing
+# in for the list of states
+
+def shard_path(directory, condition, c):
+    return os.path.join(directory, 'sim-%d-%d-%d-%d.pickle' % (condition[0], condition[1], condition[2], c))
+
+
+def write_shard(directory, condition, c, run):
+    path = shard_path(directory, condition, c)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(Trajectory.from_run(*run), f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+# the (condition, c) of every run saved in the directory, in sweep order
+def completed(directory):
+    runs = []
+    for name in os.listdir(directory):
+        if name.startswith('sim-') and name.endswith('.pickle'):
+            i, j, k, c = (int(n) for n in name[4:-7].split('-'))
+            runs.append(((i,j,k), c))
+    return sorted(runs)
+
+
+# ((i, j, k, c), (states, plans)) for every run of a sweep, in sweep order.
+# a directory is read one shard at a time, a single all.pickle all at once
+def iter_runs(path='all.pickle'):
+    if os.path.isdir(path):
+        for condition, c in completed(path):
+            with open(shard_path(path, condition, c), 'rb') as f:
+                run = pickle.load(f)
+            if isinstance(run, Trajectory):
+                run = (run, run.plans)
+            yield condition + (c,), run
+    else:
+        with open(path, 'rb') as f:
+            all_sims = pickle.load(f)
+        for i, cond1 in enumerate(all_sims):
+            for j, cond2 in enumerate(cond1):
+                for k, cond3 in enumerate(cond2):
+                    for c, run in enumerate(cond3):
+                        yield (i,j,k,c), run
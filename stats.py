@@ -1,7 +1,7 @@
-import pickle
 import csv
 import sys
 import pandas
+import shards
 
 h1 = ('h1', 'hunter')
 h2 = ('h2', 'hunter')
@@ -58,23 +58,20 @@ def process_pair(hx, hy, state):
 	collab12 = is_collaborating_agents(hx, hy, state)
 	return (d12, d12s, collab12)
 
-def write_to_csv():
+# path is all.pickle or a directory of sweep shards
+def write_to_csv(path='all.pickle'):
 	with open('dist_stats.csv', 'w') as csvfile:
 		csvwriter = csv.writer(csvfile)
 		csvwriter.writerow(['cond1','cond2','cond3','sim','state','dof','d_agents','d_stag','collab'])
-		all_data = pickle.load(open('all.pickle', 'rb'))
-		for i, cond1 in enumerate(all_data):
-			for j, cond2 in enumerate(cond1):
-				for k, cond3 in enumerate(cond2):
-					for c, (states, plans) in enumerate(cond3):
-						for s, state in enumerate(states):
-							if s != 3:
-								dof = sum([degrees_of_freedom(a, state) for a in (h1,h2,h3)])
-								for pair in [(h1,h2), (h2,h3), (h1,h3)]:
-									d = process_pair(pair[0], pair[1], state)
-									row = [i,j,k,c,s,dof,d[0],d[1],d[2]]
-									print(row)
-									csvwriter.writerow(row)
+		for (i, j, k, c), (states, plans) in shards.iter_runs(path):
+			for s, state in enumerate(states):
+				if s != 3:
+					dof = sum([degrees_of_freedom(a, state) for a in (h1,h2,h3)])
+					for pair in [(h1,h2), (h2,h3), (h1,h3)]:
+						d = process_pair(pair[0], pair[1], state)
+						row = [i,j,k,c,s,dof,d[0],d[1],d[2]]
+						print(row)
+						csvwriter.writerow(row)
 
 def read_from_csv():
 	df = pandas.read_csv('dist_stats.csv')
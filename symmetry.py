@@ -0,0 +1,241 @@
+# states that are the same up to symmetry. the rules only see an agent's
+# role, so states that differ by swapping agents of a role, or by a
+# reflection or rotation of the map that leaves the map as it is, look the
+# same to them. canonical() gives such states one key, and Zobrist keeps a
+# hash of the same things up to date as agents move
+#
+#   form = symmetry.canonical(state)
+#   form == symmetry.canonical(mirrored)   # for every mirror image of state
+#   form.order                             # state's agents in the key's order
+#
+# the planner breaks ties by roster order and by the order of the moves, so
+# equivalent states can still play out differently, and neither plans nor
+# sims are cached by form. distances are the same either way, and
+# MapAnalysis relies on that
+
+
+# the symmetries of a rectangle (swap, flip x, flip y), the identity first.
+# x is flipped, then y, then x and y are swapped, which only squares allow
+TRANSFORMS = tuple((swap, fx, fy) for swap in (False, True) for fx in (False, True) for fy in (False, True))
+
+ROLES = ('rabbit', 'stag', 'hunter')
+
+
+def apply(t, loc, width, height):
+    x, y = loc
+    swap, fx, fy = t
+    if fx:
+        x = width-1 - x
+    if fy:
+        y = height-1 - y
+    return (y, x) if swap else (x, y)
+
+
+# the transforms that leave grid as it is, the identity first
+_groups = {}
+_last = (None, None)
+
+def map_group(grid):
+    global _last
+    last = _last
+    if last[0] is grid:
+        return last[1]
+    key = tuple(map(tuple, grid))
+    group = _groups.get(key)
+    if group is None:
+        width, height = len(key), len(key[0])
+        group = tuple(t for t in TRANSFORMS if not (t[0] and width != height) and
+                      all(key[x][y] == key[tx][ty] for x in range(width) for y in range(height)
+                          for tx, ty in [apply(t, (x, y), width, height)]))
+        _groups[key] = group
+    _last = (grid, group)
+    return group
+
+
+# the least image of loc under the symmetries of grid, and the transform
+# that takes loc there
+def least_image(grid, loc):
+    group = map_group(grid)
+    if len(group) == 1:
+        return loc, group[0]
+    width, height = len(grid), len(grid[0])
+    return min((apply(t, loc, width, height), t) for t in group)
+
+
+# what the rules see of an agent under transform t: role, cell ((-1, -1) off
+# the map), captured, ready and score (-1 for agents without one)
+def local(state, agent, t, width, height, score):
+    loc = state.loc.get(agent)
+    return (ROLES.index(agent[1]) if agent[1] in ROLES else len(ROLES),
+            (-1, -1) if loc is None else apply(t, loc, width, height),
+            agent in state.captured, agent in state.ready, score.get(agent, -1))
+
+
+# (agent, label, other) for every target and goal of state that names
+# another agent
+def links(state, goal, target):
+    found = []
+    for agent, prey in target.items():
+        found.append((agent, ('target',), prey))
+    for agent, goals in goal.items():
+        for kind, args in goals.items():
+            for i, other in enumerate(args[1:]):
+                found.append((agent, (kind, i), other))
+    return found
+
+
+# the agents as a list of classes, each as its colour and members, in order
+# of colour. an agent's colour is its local view and then, round by round,
+# the colours of the agents it links to and from, until no class splits
+def refine(colours, edges):
+    while True:
+        refined = {}
+        for agent, colour in colours.items():
+            refined[agent] = (colour, tuple(sorted((label, colours[b]) for label, b in edges[agent][0])),
+                              tuple(sorted((label, colours[a]) for label, a in edges[agent][1])))
+        # the colours are numbered in order, so they stay small
+        ranks = dict((colour, i) for i, colour in enumerate(sorted(set(refined.values()))))
+        refined = dict((agent, ranks[colour]) for agent, colour in refined.items())
+        if len(ranks) == len(set(colours.values())):
+            return refined
+        colours = refined
+
+
+# the least encoding of the agents under transform t, and their order in it.
+# agents of a class with no links are all alike and are taken in roster
+# order. a class of linked agents is split by trying each of them first
+def label(colours, edges, records, agents):
+    colours = refine(colours, edges)
+    classes = {}
+    for agent in agents:
+        classes.setdefault(colours[agent], []).append(agent)
+    for colour in sorted(classes):
+        members = classes[colour]
+        if len(members) > 1 and any(edges[a][0] or edges[a][1] for a in members):
+            best = None
+            for first in members:
+                # first gets a colour of its own, just before the rest of its class
+                split = dict((agent, 2*c) for agent, c in colours.items())
+                for agent in members:
+                    if agent is not first:
+                        split[agent] += 1
+                found = label(split, edges, records, agents)
+                if best is None or found[0] < best[0]:
+                    best = found
+            return best
+    order = [agent for colour in sorted(classes) for agent in classes[colour]]
+    index = dict((agent, i) for i, agent in enumerate(order))
+    return tuple((records[agent], tuple(sorted((label, index[b]) for label, b in edges[agent][0])))
+                 for agent in order), order
+
+
+# the same key for every state that only differs from this one by agents of
+# a role swapping places or by a symmetry of the map. it also stands in for
+# that key as a dict key, with transform, the symmetry taking the state to
+# the key, and order, the state's agents in the key's order
+class Canonical:
+    __slots__ = ('key', 'transform', 'order', '_hash')
+
+    def __init__(self, key, transform, order):
+        self.key = key
+        self.transform = transform
+        self.order = tuple(order)
+        self._hash = hash(key)
+
+    def __eq__(self, other):
+        return isinstance(other, Canonical) and self._hash == other._hash and self.key == other.key
+
+    def __hash__(self):
+        return self._hash
+
+    # agent -> its place in the key
+    def relabel(self):
+        return dict((agent, i) for i, agent in enumerate(self.order))
+
+    def __repr__(self):
+        return 'Canonical(%r, %r)' % (self.transform, self.order)
+
+
+# state's canonical form, reading goal, target and score from state unless
+# they are given. ready and captured are read as sets, and assumes isn't
+# read at all, as the rules don't
+def canonical(state, goal=None, target=None, score=None):
+    goal = state.goal if goal is None else goal
+    target = state.target if target is None else target
+    score = state.score if score is None else score
+    agents = list(state.agents)
+    edges = dict((agent, ([], [])) for agent in agents)
+    for agent, kind, other in links(state, goal, target):
+        if agent in edges and other in edges:
+            edges[agent][0].append((kind, other))
+            edges[other][1].append((kind, agent))
+    grid = tuple(map(tuple, state.map))
+    width, height = len(grid), len(grid[0])
+    best = None
+    for t in map_group(state.map):
+        records = dict((agent, local(state, agent, t, width, height, score)) for agent in agents)
+        found = label(records, edges, records, agents)
+        if best is None or found[0] < best[0]:
+            best = found + (t,)
+    return Canonical((grid, best[0]), best[2], best[1])
+
+
+# 64-bit hashes, splitmix64's output function
+MASK = (1 << 64) - 1
+
+def mix(x):
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & MASK
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & MASK
+    return x ^ (x >> 31)
+
+
+def zobrist_key(record):
+    role, (x, y), captured, ready, score = record
+    packed = ((((role << 1 | captured) << 1 | ready) << 16 | (x+1)) << 16) | (y+1)
+    return mix(mix(packed) + score + 1)
+
+
+# a hash of the canonical form of a state, kept up to date as its agents
+# change: the sum (mod 2**64) of a key for each agent's local view, one hash
+# under each symmetry of the map, and the least of those. agents with the
+# same view have the same key, so the hash doesn't change when they swap,
+# and as the keys are added rather than xored, two of them don't cancel
+# out. targets and goals aren't hashed, so states with the same hash can
+# still have different forms. it is a helper of its own: Canonical keys
+# are hashed in full
+#
+#   h = symmetry.Zobrist(state)
+#   before = h.view(state, agent); <agent moves>; h.changed(before, h.view(state, agent))
+class Zobrist:
+
+    def __init__(self, state, score=None):
+        self.group = map_group(state.map)
+        self.width, self.height = len(state.map), len(state.map[0])
+        self.hashes = [0] * len(self.group)
+        score = state.score if score is None else score
+        for agent in state.agents:
+            self.add(self.view(state, agent, score), 1)
+
+    # what the hash sees of agent, untransformed
+    def view(self, state, agent, score=None):
+        return local(state, agent, self.group[0], self.width, self.height, state.score if score is None else score)
+
+    # count record in the hashes once more (sign 1) or once less (sign -1)
+    def add(self, record, sign):
+        role, loc, captured, ready, score = record
+        for i, t in enumerate(self.group):
+            if loc != (-1, -1):
+                record = (role, apply(t, loc, self.width, self.height), captured, ready, score)
+            self.hashes[i] = (self.hashes[i] + sign * zobrist_key(record)) & MASK
+
+    # an agent's view went from before to after
+    def changed(self, before, after):
+        if before != after:
+            self.add(before, -1)
+            self.add(after, 1)
+
+    def value(self):
+        return min(self.hashes)
+
+    def __int__(self):
+        return self.value()
@@ -1,6 +1,31 @@
 import unittest
+import pickle
+import json
+import io
+import os
+import tempfile
+import contextlib
+import random
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from copy import deepcopy
+import pyhop
+import trajectory
+import shards
+import events
+import a_start
 import run_sim
+import coalitions
+import symmetry
 import models.staghunt_htn
+import models.compact
+import to_json
+try:
+    import numpy
+    import columnar
+    import batch_sim
+    import scenarios
+except ImportError:
+    numpy = None
 
 # stag tests
 
@@ -260,6 +285,837 @@ class PassTest(unittest.TestCase):
             print('score', i, states[i].score)
 
 
+class PlannerTest(unittest.TestCase):
+
+    def get_planner(self, **kwargs):
+        planner = pyhop.Pyhop('test-hop', **kwargs)
+        models.staghunt_htn.load_operators(planner)
+        models.staghunt_htn.load_methods(planner)
+        return planner
+
+    def get_states(self):
+        states = []
+        for c in range(5):
+            state = PassTest().get_start_state()
+            run_sim.assignGoals(state, c)
+            states.append(state)
+        state = PassTest().get_start_state()
+        state.loc[('s2', 'stag')] = (4,1)
+        state.loc[('h2', 'hunter')] = (3,1)
+        state.loc[('h3', 'hunter')] = (4,2)
+        state.ready = [('h2', 'hunter'), ('h3', 'hunter')]
+        run_sim.assignGoals(state, 3)
+        states.append(state)
+        return states
+
+    def testUndoMatchesCopy(self):
+        copying = self.get_planner()
+        undoing = self.get_planner(undo=True)
+        for state in self.get_states():
+            before = deepcopy(state)
+            plan = undoing.pyhop(state, [('sim_all',)])
+            self.assertEqual(plan, copying.pyhop(state, [('sim_all',)]))
+            # the working state is rolled back before the plan is returned
+            self.assertEqual(vars(state), vars(before))
+
+    def testIterativeMatchesRecursive(self):
+        recursive = self.get_planner()
+        for kwargs in ({'iterative': True}, {'iterative': True, 'undo': True}):
+            iterative = self.get_planner(**kwargs)
+            for state in self.get_states():
+                expected = recursive.pyhop(state, [('sim_all',)])
+                self.assertEqual(pickle.dumps(iterative.pyhop(state, [('sim_all',)])), pickle.dumps(expected))
+
+    def testMemoMatchesPlanning(self):
+        memo = pyhop.TranspositionTable(models.staghunt_htn.MEMO_TASKS)
+        for state in self.get_states():
+            _,expected = run_sim.simulate_state(deepcopy(state), 3)
+            _,plans = run_sim.simulate_state(deepcopy(state), 3, memo=memo)
+            self.assertEqual(pickle.dumps(plans), pickle.dumps(expected))
+        self.assertGreater(memo.hits, 0)
+        self.assertEqual(memo.stats()['misses'], memo.misses)
+        state = self.get_states()[-1]
+        run_sim.SHARED_MOVES = True
+        try:
+            _,plans = run_sim.simulate_state(deepcopy(state), 3, run_sim.decide)
+        finally:
+            run_sim.SHARED_MOVES = False
+        self.assertEqual(plans, run_sim.simulate_state(deepcopy(state), 3, run_sim.decide)[1])
+
+    def testMemoBacktracksIntoTask(self):
+        def set_x(state, x):
+            state.x = x
+            return state
+        def check_x(state, x):
+            return state if state.x == x else False
+        def first(state):
+            return [('set_x', 1)]
+        def second(state):
+            return [('set_x', 2)]
+        for kwargs in ({}, {'undo': True}):
+            memo = pyhop.TranspositionTable({'choose': ('x',)})
+            planner = pyhop.Pyhop('memo-hop', memo=memo, **kwargs)
+            planner.declare_operators(set_x, check_x)
+            planner.declare_methods('choose', first, second)
+            state = pyhop.State('state')
+            state.x = 0
+            # the remembered set_x 1 doesn't do, so the second method is tried
+            for _ in range(2):
+                self.assertEqual([step[0] for step in planner.pyhop(state, [('choose',), ('check_x', 2)])],
+                                 [('set_x', 2), ('check_x', 2)])
+            self.assertEqual(memo.hits, 1)
+
+    def testStatsMatchBetweenEngines(self):
+        counts = []
+        for kwargs in ({}, {'iterative': True, 'undo': True}):
+            stats = pyhop.PlannerStats()
+            planner = self.get_planner(stats=stats, **kwargs)
+            for state in self.get_states():
+                planner.pyhop(state, [('sim_all',)])
+            counts.append(dict((name, c[:5]) for name, c in stats.counters.items()))
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(counts[0]['simulate_step_forall'], ['method', 6, 6, 0, 0])
+        self.assertGreater(counts[0]['step_up'][3] + counts[0]['step_down'][3], 0)
+        out = io.StringIO()
+        stats.dump(out)
+        self.assertEqual(json.loads(out.getvalue())['plan']['kind'], 'method')
+
+    def testCompiledDomain(self):
+        domain = pickle.loads(pickle.dumps(models.staghunt_htn.load_domain()))
+        self.assertEqual([fn.__name__ for _,fn in domain.alternatives['move_away_from'][:2]], ['move_away_up', 'move_away_down'])
+        self.assertEqual(domain.alternatives['wait_one'], ((True, models.staghunt_htn.wait_one),))
+        with self.assertRaises(AttributeError):
+            domain.operators = {}
+        declared = self.get_planner()
+        for kwargs in ({}, {'iterative': True}):
+            compiled = pyhop.Pyhop('compiled-hop', domain=domain, **kwargs)
+            with self.assertRaises(TypeError):
+                compiled.declare_operators(models.staghunt_htn.wait_one)
+            for state in self.get_states():
+                self.assertEqual(compiled.pyhop(state, [('sim_all',)]), declared.pyhop(state, [('sim_all',)]))
+        # a declared planner compiles once, and again after new declarations
+        self.assertIs(declared.compile(), declared.compile())
+        before = declared.compile()
+        declared.declare_methods('wait_one', models.staghunt_htn.wait_one)
+        self.assertIsNot(declared.compile(), before)
+        self.assertEqual(declared.compile().alternatives['wait_one'][-1], (False, models.staghunt_htn.wait_one))
+
+    def testPlanWithFinalState(self):
+        plain = self.get_planner()
+        memo = pyhop.TranspositionTable(models.staghunt_htn.MEMO_TASKS)
+        for kwargs in ({}, {'undo': True}, {'memo': memo}, {'undo': True, 'iterative': True}):
+            planner = self.get_planner(**kwargs)
+            for state in self.get_states():
+                before = deepcopy(state)
+                plan, newstate = planner.pyhop_state(state, [('sim_all',)])
+                self.assertEqual(plan, plain.pyhop(state, [('sim_all',)]))
+                self.assertEqual(vars(state), vars(before))
+                for action in plan:
+                    plain.operators[action[0][0]](before, *action[0][1:])
+                self.assertEqual(vars(newstate), vars(before))
+                self.assertIsNot(newstate.loc, state.loc)
+                self.assertIsNot(newstate.goal, state.goal)
+        # nothing to do still gives a state of its own
+        state = PassTest().get_start_state()
+        plan, newstate = plain.pyhop_state(state, [])
+        self.assertEqual(plan, [])
+        self.assertIsNot(newstate, state)
+        self.assertEqual(vars(newstate), vars(state))
+
+    def testIncrementalMatchesFull(self):
+        random.seed(5)
+        states = self.get_states() + [run_sim.get_start_state_rand((i, 2-i, i)) for i in range(3)]
+        for undo in (False, True):
+            for state in states:
+                cache = pyhop.SubplanCache(models.staghunt_htn.SUBPLAN_TASKS, run_sim.DOMAIN)
+                full = self.get_planner(undo=undo)
+                incremental = self.get_planner(undo=undo, memo=cache)
+                for _ in range(8):
+                    plan, newstate = incremental.pyhop_state(state, [('sim_all',)])
+                    expected, fullstate = full.pyhop_state(state, [('sim_all',)])
+                    self.assertEqual(plan, expected)
+                    self.assertEqual(vars(newstate), vars(fullstate))
+                    state = newstate
+                self.assertGreater(cache.hits, 0)
+        run_sim.INCREMENTAL = True
+        try:
+            _,plans = run_sim.simulate_state(deepcopy(states[-1]), 4, run_sim.decide)
+        finally:
+            run_sim.INCREMENTAL = False
+        self.assertEqual(plans, run_sim.simulate_state(deepcopy(states[-1]), 4, run_sim.decide)[1])
+
+    def testSubplanGoesStale(self):
+        cache = pyhop.SubplanCache(models.staghunt_htn.SUBPLAN_TASKS, run_sim.DOMAIN)
+        planner = self.get_planner(undo=True, iterative=True, memo=cache)
+        state = PassTest().get_start_state()
+        stag = ('s3', 'stag')
+        task = [('simulate_agent', stag)]
+        self.assertEqual([step[0] for step in planner.pyhop(state, task)], [('wait_one', stag)])
+        planner.pyhop(state, task)
+        self.assertEqual((cache.hits, cache.stale), (1, 0))
+        # a hunter moves next to the stag, which has to run now
+        state.loc[('h2', 'hunter')] = (state.loc[stag][0]+1, state.loc[stag][1])
+        plan = planner.pyhop(state, task)
+        self.assertEqual(plan, self.get_planner().pyhop(state, task))
+        self.assertNotEqual(plan[0][0], ('wait_one', stag))
+        self.assertEqual(cache.stale, 1)
+
+    def testIterativeManyAgents(self):
+        state = PassTest().get_start_state()
+        state.agents = [(f'r{i}', 'rabbit') for i in range(600)]
+        state.loc = {agent: (1,1) for agent in state.agents}
+        planner = self.get_planner(iterative=True, undo=True)
+        plan = planner.pyhop(state, [('sim_all',)], maxdepth=None)
+        self.assertEqual(len(plan), 600)
+        self.assertEqual(len(plan[-1][1]), 2*600)
+
+    def testHuntStateCopies(self):
+        state = PassTest().get_start_state()
+        state.loc = models.staghunt_htn.LocIndex(state.loc)
+        state.map = models.staghunt_htn.intern_map(state.map)
+        self.assertIs(state.map, models.staghunt_htn.intern_map(run_sim.map5x5x3))
+        run_sim.decide(state)
+        copied = deepcopy(state)
+        self.assertEqual(vars(copied), vars(state))
+        self.assertIs(copied.map, state.map)
+        self.assertIs(copied.agents, state.agents)
+        for name in models.staghunt_htn.SHALLOW:
+            self.assertIsNot(getattr(copied, name), getattr(state, name))
+        # the goals still alias the assumptions they were picked from
+        h2 = ('h2', 'hunter')
+        self.assertIs(state.goal[h2], state.assumes[h2][h2])
+        self.assertIs(copied.goal[h2], copied.assumes[h2][h2])
+        self.assertIsNot(copied.goal[h2], state.goal[h2])
+        copied.loc[h2] = (1,1)
+        self.assertEqual(state.loc[h2], (2,1))
+        self.assertEqual(copied.loc.at((1,1), 'hunter'), [h2])
+        self.assertEqual(state.loc.at((1,1), 'hunter'), ())
+
+
+class CompactTest(unittest.TestCase):
+
+    def testRunsLikeTupleState(self):
+        for state in PlannerTest().get_states():
+            compact = models.compact.CompactState.from_state(state)
+            self.assertEqual(vars(compact.to_state()), vars(state))
+            expected_states,expected = run_sim.simulate_state(deepcopy(state), 3, run_sim.decide)
+            states,plans = run_sim.simulate_state(deepcopy(compact), 3, run_sim.decide)
+            self.assertEqual(plans, expected)
+            self.assertEqual([vars(s.to_state()) for s in states], [vars(s) for s in expected_states])
+            before = pickle.dumps(compact)
+            plan = PlannerTest().get_planner().pyhop(state, [('sim_all',)])
+            memo = pyhop.TranspositionTable(models.staghunt_htn.MEMO_TASKS)
+            for domain in (run_sim.DOMAIN, models.compact.DOMAIN):
+                for kwargs in ({}, {'undo': True, 'iterative': True}, {'undo': True, 'memo': memo}):
+                    planner = pyhop.Pyhop('compact-hop', domain=domain, **kwargs)
+                    self.assertEqual(planner.pyhop(compact, [('sim_all',)]), plan)
+                    # the undo log rolls the arrays back
+                    self.assertEqual(pickle.dumps(compact), before)
+        # the id-based rules measure geodesic distances as the tuple ones do
+        state = PlannerTest().get_states()[-1]
+        models.staghunt_htn.GEODESIC = True
+        try:
+            plan = PlannerTest().get_planner().pyhop(state, [('sim_all',)])
+            planner = pyhop.Pyhop('compact-hop', domain=models.compact.DOMAIN, undo=True)
+            self.assertEqual(planner.pyhop(models.compact.CompactState.from_state(state), [('sim_all',)]), plan)
+        finally:
+            models.staghunt_htn.GEODESIC = False
+
+    def testViews(self):
+        state = PassTest().get_start_state()
+        compact = models.compact.CompactState.from_state(state)
+        h1, r1 = ('h1', 'hunter'), ('r1', 'rabbit')
+        self.assertEqual(compact.loc, state.loc)
+        self.assertEqual(compact.roster.ids[h1], 5)
+        self.assertTrue(models.compact.hunts_id(compact.roster, 5, 0))
+        self.assertFalse(models.compact.hunts_id(compact.roster, 0, 5))
+        compact.captured.append(r1)
+        del compact.loc[r1]
+        compact.ready.append(h1)
+        compact.ready.remove(h1)
+        compact.score[h1] += 2
+        self.assertEqual((compact.captured, compact.ready, compact.score[h1]), ([r1], [], 2))
+        self.assertNotIn(r1, compact.loc)
+        copied = pickle.loads(pickle.dumps(compact))
+        self.assertEqual(vars(copied.to_state()), vars(compact.to_state()))
+        self.assertEqual(pyhop.fingerprint(copied), pyhop.fingerprint(compact))
+        self.assertEqual(to_json.state_to_json(compact, 0), to_json.state_to_json(compact.to_state(), 0))
+
+    def testCellIndex(self):
+        state = PassTest().get_start_state()
+        compact = models.compact.CompactState.from_state(state)
+        indexed = lambda compact: dict((cell, dict((role, sorted(agents)) for role, agents in roles.items())) for cell, roles in compact.cells().items())
+        expected = indexed(models.compact.CompactState.from_state(state))
+        self.assertEqual(expected, LocIndexTest().cells(models.staghunt_htn.LocIndex(state.loc)))
+        self.assertIs(compact.loc, compact.loc)
+        self.assertTrue(models.staghunt_htn.indexed(compact.loc))
+        h1, s1 = ('h1', 'hunter'), ('s1', 'stag')
+        log = []
+        view = pyhop.journal(compact, log)
+        view.loc[h1] = state.loc[s1]
+        del view.loc[s1]
+        self.assertEqual(compact.loc.at(state.loc[s1], 'hunter'), [h1])
+        self.assertEqual(compact.loc.at(state.loc[s1], 'stag'), ())
+        self.assertEqual(indexed(deepcopy(compact)), indexed(compact))
+        pyhop.rollback(log)
+        self.assertEqual(dict(compact.loc), dict(state.loc))
+        self.assertEqual(indexed(compact), expected)
+        # replacing the arrays outdates the index, which is rebuilt
+        compact.loc = {h1: (1,1)}
+        self.assertEqual(compact.cells(), {(1,1): {'hunter': [h1]}})
+        self.assertEqual(indexed(pickle.loads(pickle.dumps(compact))), indexed(compact))
+
+
+class PathTest(unittest.TestCase):
+
+    def testGridMatchesStateSearch(self):
+        hunter = ('h1', 'hunter')
+        steps = [models.staghunt_htn.step_up, models.staghunt_htn.step_down, models.staghunt_htn.step_left, models.staghunt_htn.step_right]
+        grid = run_sim.map5x5x3
+        cells = [(x,y) for x in range(len(grid)) for y in range(len(grid[x])) if grid[x][y] > 0]
+        for start in cells:
+            for goal in cells:
+                state = pyhop.State('path')
+                state.map = grid
+                state.loc = {hunter: start}
+                path = a_start.a_star_search(state, hunter, goal, steps)
+                self.assertEqual(a_start.a_star_grid(grid, start, goal), [step.__name__ for step in path])
+
+    def testMapAnalysis(self):
+        grid = run_sim.map7x7x3
+        analysis = a_start.analyze(grid)
+        self.assertIs(a_start.analyze(deepcopy(grid)), analysis)
+        cells = [(x,y) for x in range(len(grid)) for y in range(len(grid[x])) if grid[x][y] > 0]
+        for goal in cells:
+            for start in cells:
+                path = a_start.a_star_grid(grid, start, goal)
+                self.assertEqual(analysis.next_step(start, goal), path[0] if path else None)
+                self.assertEqual(analysis.distance(start, goal), None if path is None else len(path))
+        # large maps keep as many fields as fit in max_cells
+        small = a_start.MapAnalysis(tuple(map(tuple, grid)), max_cells=3*len(grid)*len(grid[0]))
+        small.prefetch(cells)
+        self.assertEqual(len(small.fields), 3)
+        for goal in cells[::7]:
+            self.assertEqual(small.distance(cells[0], goal), analysis.distance(cells[0], goal))
+        self.assertLessEqual(len(small.fields), 3)
+
+    def testDistanceFields(self):
+        grid = run_sim.map9x9x5
+        cells = [(x,y) for x in range(len(grid)) for y in range(len(grid[x])) if grid[x][y] > 0]
+        fields = a_start.distance_fields(grid, cells)
+        self.assertEqual(fields.shape, (len(cells), len(grid), len(grid[0])))
+        for i, goal in enumerate(cells):
+            for start in cells:
+                path = a_start.a_star_grid(grid, start, goal)
+                self.assertEqual(fields[i][start], -1 if path is None else len(path))
+        self.assertEqual(fields[0][0][0], -1)
+
+    def testGeodesicTargets(self):
+        state = PassTest().get_start_state()
+        hunter = ('h1', 'hunter')
+        state.loc[hunter] = (1,3)
+        state.loc[('r1', 'rabbit')] = (4,3)
+        state.loc[('r2', 'rabbit')] = (3,5)
+        # r1 is closer as the crow flies, but the walls make it further to walk
+        self.assertEqual(models.staghunt_htn.distance(state, hunter, ('r1', 'rabbit')), 3)
+        self.assertEqual(models.staghunt_htn.path_distance(state, hunter, ('r1', 'rabbit')), 7)
+        models.staghunt_htn.pick_closest_target(state, hunter)
+        self.assertEqual(state.target[hunter], ('r1', 'rabbit'))
+        models.staghunt_htn.GEODESIC = True
+        try:
+            models.staghunt_htn.pick_closest_target(state, hunter)
+        finally:
+            models.staghunt_htn.GEODESIC = False
+        self.assertEqual(state.target[hunter], ('r2', 'rabbit'))
+
+    def testGridNoPath(self):
+        self.assertIsNone(a_start.a_star_grid(run_sim.map5x5x5, (1,2), (1,1)))
+
+
+class LocIndexTest(unittest.TestCase):
+
+    # the cells of a LocIndex, each role's agents sorted
+    def cells(self, index):
+        return dict((cell, dict((role, sorted(agents)) for role, agents in roles.items())) for cell, roles in index.cells.items())
+
+    def assertIndexed(self, loc):
+        self.assertIsInstance(loc, models.staghunt_htn.LocIndex)
+        self.assertEqual(self.cells(loc), self.cells(models.staghunt_htn.LocIndex(dict(loc))))
+
+    def testIndexFollowsLoc(self):
+        loc = models.staghunt_htn.LocIndex(PassTest().get_start_state().loc)
+        self.assertEqual(loc.at((4,4), 'hunter'), [('h1', 'hunter')])
+        loc[('h1', 'hunter')] = (4,3)
+        self.assertEqual(loc.at((4,4), 'hunter'), ())
+        self.assertEqual(sorted(loc.at((4,3), 'hunter')), [('h1', 'hunter'), ('h3', 'hunter')])
+        del loc[('r1', 'rabbit')]
+        self.assertEqual(loc.pop(('r2', 'rabbit')), (4,1))
+        self.assertNotIn((5,3), loc.cells)
+        self.assertIndexed(loc)
+        self.assertIndexed(deepcopy(loc))
+        self.assertIndexed(pickle.loads(pickle.dumps(loc)))
+        state = PassTest().get_start_state()
+        state.loc = loc
+        log = []
+        view = pyhop.journal(state, log)
+        view.loc[('s1', 'stag')] = (1,1)
+        view.loc.clear()
+        self.assertEqual(loc.at((1,1), 'stag'), ())
+        pyhop.rollback(log)
+        self.assertEqual(loc[('s1', 'stag')], (3,4))
+        self.assertIndexed(loc)
+
+    def testJournalRollsBack(self):
+        state = PassTest().get_start_state()
+        state.loc = models.staghunt_htn.LocIndex(state.loc)
+        state.goal = {}
+        before = deepcopy(state)
+        h1 = ('h1', 'hunter')
+        log = []
+        view = pyhop.journal(state, log)
+        view.loc[('s1', 'stag')] = (1,1)
+        del view.loc[('r1', 'rabbit')]
+        view.ready.append(h1)
+        view.goal.setdefault(h1, {})['hunt'] = (h1, ('s1', 'stag'))
+        view.score[h1] += 3
+        view.captured = [('r1', 'rabbit')]
+        view.captured.append(('s1', 'stag'))
+        # one entry per change, not per variable
+        self.assertEqual(len(log), 8)
+        self.assertIn(h1, state.ready)
+        pyhop.rollback(log)
+        self.assertEqual(log, [])
+        self.assertEqual(vars(state), vars(before))
+        self.assertIndexed(state.loc)
+
+    def testIndexedMatchesPlain(self):
+        states = PlannerTest().get_states()
+        # a crowded cell: two stags and a rabbit under three ready hunters
+        state = PassTest().get_start_state()
+        for agent in state.agents:
+            if agent[1] != 'rabbit' or agent[0] == 'r1':
+                state.loc[agent] = (4,3)
+        state.ready = [('h3', 'hunter'), ('h1', 'hunter'), ('h2', 'hunter')]
+        states.append(state)
+        for state in states:
+            indexed = deepcopy(state)
+            indexed.loc = models.staghunt_htn.LocIndex(state.loc)
+            expected_states,expected = run_sim.simulate_state(state, 3)
+            indexed_states,plans = run_sim.simulate_state(indexed, 3)
+            self.assertEqual(plans, expected)
+            for a, b in zip(indexed_states, expected_states):
+                self.assertIndexed(a.loc)
+                self.assertEqual(vars(a), vars(b))
+
+
+class SweepTest(unittest.TestCase):
+
+    def testSweepIndependentOfWorkers(self):
+        jobs = [((0,0,0), 0), ((0,0,0), 1), ((2,1,0), 0)]
+        one = pickle.dumps(run_sim.run_sweep(jobs, 7, workers=1))
+        self.assertEqual(pickle.dumps(run_sim.run_sweep(jobs, 7, workers=3)), one)
+        self.assertNotEqual(pickle.dumps(run_sim.run_sweep(jobs, 8, workers=2)), one)
+        self.assertEqual(len(run_sim.sweep_jobs()), 3*3*3*30)
+
+    def testDecideWithExecutor(self):
+        states = PlannerTest().get_states()[:2] + [PassTest().get_start_state()]
+        with ProcessPoolExecutor(2) as pool:
+            for state in states:
+                serial = deepcopy(state)
+                run_sim.decide(serial)
+                run_sim.decide(state, pool)
+                self.assertEqual((state.goal, state.assumes), (serial.goal, serial.assumes))
+            random.seed(3)
+            expected_states,expected = run_sim.run_one((0,1,1))
+            random.seed(3)
+            states,plans = run_sim.run_one((0,1,1), pool)
+            self.assertEqual(plans, expected)
+            self.assertEqual([vars(s) for s in states], [vars(s) for s in expected_states])
+
+    def testDecideWithThreads(self):
+        random.seed(3)
+        expected_states,expected = run_sim.run_one((0,1,1))
+        # the sims fill in a fresh map analysis from several threads at once
+        a_start._analyses.clear()
+        with ThreadPoolExecutor(4) as pool:
+            random.seed(3)
+            states,plans = run_sim.run_one((0,1,1), pool)
+        self.assertEqual(plans, expected)
+        self.assertEqual([vars(s) for s in states], [vars(s) for s in expected_states])
+
+    def testMentalSimCache(self):
+        cache = pyhop.LRUCache(64)
+        for state in PlannerTest().get_states()[:3]:
+            serial = deepcopy(state)
+            run_sim.decide(serial)
+            for _ in range(2):
+                cached = deepcopy(state)
+                run_sim.decide(cached, cache=cache)
+                self.assertEqual((cached.goal, cached.assumes), (serial.goal, serial.assumes))
+        # the scenarios only differ in their goals, which the sims replace,
+        # and decide sims the four goal sets it picks from
+        self.assertEqual(cache.misses, 4)
+        self.assertEqual(cache.hits, 20)
+        self.assertEqual(len(cache), 4)
+        random.seed(4)
+        expected_states,expected = run_sim.run_one((1,0,2))
+        random.seed(4)
+        states,plans = run_sim.run_one((1,0,2), cache=cache)
+        self.assertEqual(plans, expected)
+        self.assertEqual([vars(s) for s in states], [vars(s) for s in expected_states])
+
+    def testResumableShards(self):
+        jobs = [((0,0,0), 0), ((0,0,1), 0), ((0,0,0), 1)]
+        with tempfile.TemporaryDirectory() as directory:
+            run_sim.run_shards(jobs, directory, seed=5, workers=2)
+            self.assertEqual(shards.completed(directory), sorted(jobs))
+            kept = os.stat(shards.shard_path(directory, (0,0,0), 0)).st_mtime_ns
+            os.remove(shards.shard_path(directory, (0,0,0), 1))
+            # a shard that was being written when the sweep died
+            open(shards.shard_path(directory, (0,0,0), 1) + '.tmp', 'wb').close()
+            run_sim.run_shards(jobs, directory, seed=5, workers=2)
+            self.assertEqual(os.stat(shards.shard_path(directory, (0,0,0), 0)).st_mtime_ns, kept)
+            runs = list(shards.iter_runs(directory))
+        self.assertEqual([key for key, _ in runs], [(0,0,0,0), (0,0,0,1), (0,0,1,0)])
+        expected = run_sim.run_sweep(sorted(jobs), 5, workers=1)
+        for (_, (states, plans)), (expected_states, expected_plans) in zip(runs, expected):
+            self.assertEqual([vars(s) for s in states], [vars(s) for s in expected_states])
+            self.assertEqual([[p[0] for p in plan] for plan in plans], [[p[0] for p in plan] for plan in expected_plans])
+
+    def testLegacyPickle(self):
+        key, (states, plans) = next(shards.iter_runs('all.pickle'))
+        self.assertEqual(key, (0,0,0,0))
+        self.assertEqual(len(states), len(plans) + 1)
+
+
+class TrajectoryTest(unittest.TestCase):
+
+    def testReplayMatchesRun(self):
+        states,plans = run_sim.simulate_state(PassTest().get_start_state(), 3, run_sim.decide)
+        t = trajectory.Trajectory.from_run(states, plans, cache_size=2)
+        self.assertEqual(len(t), len(states))
+        # decide sets the goals before each step, the plans do the rest
+        self.assertEqual(sorted(t.decisions), [1, 2])
+        self.assertEqual(set(t.decisions[1]), {'goal', 'assumes'})
+        for s in (3, 1, 2, 0, -1):
+            self.assertEqual(vars(t[s]), vars(states[s]))
+        self.assertEqual([vars(s) for s in t[1:]], [vars(s) for s in states[1:]])
+        self.assertEqual([[p[0] for p in plan] for plan in t.plans], [[p[0] for p in plan] for plan in plans])
+        loaded = pickle.loads(pickle.dumps(t))
+        self.assertEqual([vars(s) for s in loaded], [vars(s) for s in states])
+        self.assertLess(len(pickle.dumps(t)), len(pickle.dumps((states, plans))))
+        with self.assertRaises(IndexError):
+            t[len(t)]
+
+    @unittest.skipUnless(numpy, 'needs numpy')
+    def testColumnarStore(self):
+        with tempfile.TemporaryDirectory() as directory:
+            columnar.convert('all.pickle', directory)
+            store = columnar.ColumnarStore(directory)
+            self.assertIsInstance(store.steps, numpy.memmap)
+            runs = store.condition(2, 1, 0)
+            self.assertEqual(len(runs), 30)
+            r = runs[4]
+            for key, (states, plans) in shards.iter_runs('all.pickle'):
+                if key == (2,1,0,4):
+                    break
+            self.assertEqual(store.map(r), states[0].map)
+            self.assertEqual(store.runs['steps'][r], len(states))
+            h1, h2 = store.agent('h1'), store.agent('h2')
+            for s, state in enumerate(states):
+                self.assertEqual(tuple(store.steps['loc'][r, s, h1]), state.loc[('h1', 'hunter')])
+                self.assertEqual(store.steps['score'][r, s, h2], state.score[('h2', 'hunter')])
+                for agent in state.agents:
+                    self.assertEqual(store.steps['captured'][r, s, store.agent(agent[0])], agent in state.captured)
+            del store
+        # shards are read as trajectories, once to size the tables and once to fill them
+        with tempfile.TemporaryDirectory() as directory:
+            random.seed(2)
+            run = run_sim.run_one((0,1,2))
+            shards.write_shard(directory, (0,1,2), 3, run)
+            columnar.convert(directory, os.path.join(directory, 'out'))
+            store = columnar.ColumnarStore(os.path.join(directory, 'out'))
+            self.assertEqual(store.runs['sim'].tolist(), [3])
+            self.assertEqual(store.runs['steps'][0], len(run[0]))
+            # counts and agent indices hold values past the i2 range
+            self.assertEqual(store.runs.dtype['steps'], numpy.dtype('i4'))
+            self.assertEqual(store.steps.dtype['target'].base, numpy.dtype('i4'))
+            h3 = store.agent('h3')
+            self.assertEqual([tuple(loc) for loc in store.steps['loc'][0, :, h3]], [s.loc[('h3', 'hunter')] for s in run[0]])
+            del store
+
+
+class StreamTest(unittest.TestCase):
+
+    def testStreamMatchesLists(self):
+        states,plans = run_sim.simulate_state(PassTest().get_start_state(), 3, run_sim.decide)
+        stream = list(run_sim.iter_simulate(PassTest().get_start_state(), 3, run_sim.decide))
+        self.assertEqual([step for step, _, _ in stream], [0, 1, 2, 3])
+        self.assertEqual([plan for _, _, plan in stream], plans + [None])
+        self.assertEqual([vars(s) for _, s, _ in stream], [vars(s) for s in states])
+
+    def testRetention(self):
+        every = run_sim.History(every=4)
+        window = run_sim.History(window=3)
+        both = run_sim.History(every=2, window=2)
+        for history in (every, window, both):
+            for step, state, plan in run_sim.iter_simulate(PassTest().get_start_state(), 10, history=history):
+                pass
+        self.assertEqual([step for step, _, _ in every.entries], [0, 4, 8])
+        self.assertEqual([step for step, _, _ in window.entries], [8, 9, 10])
+        self.assertEqual([step for step, _, _ in both.entries], [8, 10])
+        self.assertEqual(len(window.plans), 2)
+        self.assertEqual(vars(window.states[-1]), vars(state))
+
+    def testUnboundedStream(self):
+        stream = run_sim.iter_simulate(PassTest().get_start_state())
+        for step, state, plan in stream:
+            if step == 50:
+                break
+        stream.close()
+        self.assertEqual(sorted(state.captured), [('r1', 'rabbit'), ('r2', 'rabbit'), ('s2', 'stag')])
+
+
+@unittest.skipUnless(numpy, 'needs numpy')
+class BatchSimTest(unittest.TestCase):
+
+    def get_states(self):
+        states = PlannerTest().get_states()
+        random.seed(7)
+        for condition in ((0,0,0), (1,2,1), (2,1,2), (2,2,0)):
+            for _ in range(3):
+                states.append(run_sim.get_start_state_rand(condition))
+        return states
+
+    def assertSameState(self, state, expected):
+        self.assertEqual(state.loc, dict(expected.loc))
+        self.assertEqual(state.score, expected.score)
+        self.assertEqual(state.target, expected.target)
+        self.assertEqual(state.goal, expected.goal)
+        self.assertEqual(set(state.captured), set(expected.captured))
+        self.assertEqual(set(state.ready), set(expected.ready))
+
+    def testMatchesPlanner(self):
+        states = self.get_states()
+        runs = [[s for _, s, _ in run_sim.iter_simulate(deepcopy(state), 12)] for state in states]
+        batch = batch_sim.Batch.from_states(states)
+        # a batch that can only keep the next steps of a few goals at a time
+        small = batch_sim.Batch.from_states(states)
+        small.max_goals = 2
+        for step in range(13):
+            for state, run in zip(batch.to_states(), runs):
+                self.assertSameState(state, run[step])
+            for state, run in zip(small.to_states(), runs):
+                self.assertSameState(state, run[step])
+            batch.step()
+            small.step()
+        self.assertLessEqual(len(batch.rows) * batch.cells, batch_sim.TABLE_CELLS)
+        self.assertLess(len(small.slots), len(batch.slots))
+
+    def testRoundTrip(self):
+        states = self.get_states()
+        for state, expected in zip(batch_sim.Batch.from_states(states).to_states(), states):
+            self.assertEqual(state.agents, expected.agents)
+            self.assertEqual(state.map, expected.map)
+            self.assertSameState(state, expected)
+
+    def testRosterOrder(self):
+        state = PassTest().get_start_state()
+        swapped = deepcopy(state)
+        swapped.agents = state.agents[::-1]
+        with self.assertRaises(ValueError):
+            batch_sim.Batch.from_states([state, swapped])
+
+
+@unittest.skipUnless(numpy, 'needs numpy')
+class ScenarioTest(unittest.TestCase):
+
+    def testMaps(self):
+        for i, size in enumerate(scenarios.SIZES[:5]):
+            for j, density in enumerate(scenarios.DENSITIES):
+                grid = numpy.array(scenarios.pick_map(i, j, 3))
+                self.assertEqual(grid.shape, (size+2, size+2))
+                self.assertFalse(grid[0].any() or grid[-1].any() or grid[:, 0].any() or grid[:, -1].any())
+                self.assertEqual(size*size - grid.sum(), round(density*size*size))
+                # every open cell can be reached from every other
+                self.assertEqual(scenarios.largest_region(grid).sum(), grid.sum())
+        self.assertIs(scenarios.pick_map(2, 1, 3), scenarios.pick_map(2, 1, 3))
+        self.assertNotEqual(scenarios.pick_map(2, 1, 3), scenarios.pick_map(2, 1, 4))
+
+    def testPlacement(self):
+        states = scenarios.start_states((1, 2, 2), seed=3, count=50, rabbits=4, hunters=5)
+        self.assertEqual(len(states[0].agents), 4 + 3 + 5)
+        for state in states:
+            self.assertEqual(len(set(state.loc.values())), len(state.agents))
+            self.assertTrue(all(state.map[x][y] > 0 for x, y in state.loc.values()))
+        # a run is the same whichever runs are placed with it
+        self.assertEqual(scenarios.start_state((1, 2, 2), 3, 17, 4, 5).loc, states[17].loc)
+        grid = scenarios.pick_map(0, 2, 0)
+        cells = int(numpy.sum(grid))
+        full = scenarios.place(grid, cells, 1, range(20))
+        self.assertTrue(all(len(set(map(tuple, run))) == cells for run in full))
+        with self.assertRaises(ValueError):
+            scenarios.place(grid, cells+1, 1, range(1))
+
+    def testSimulate(self):
+        state = scenarios.start_state((3, 1, 0), seed=2)
+        run_sim.assignGoals(state, 1)
+        states,plans = run_sim.simulate_state(state, 3, run_sim.decide)
+        self.assertEqual(len(states), 4)
+        batch = batch_sim.Batch.from_states(scenarios.start_states((3, 1, 0), seed=2, count=20))
+        batch.run(3)
+        self.assertEqual(len(batch.to_states()), 20)
+        # far more agents than the planner's default depth limit allows for
+        state = scenarios.start_state((4, 0, 2), seed=1, rabbits=150, hunters=150)
+        states,plans = run_sim.simulate_state(state, 2)
+        self.assertEqual(len(states), 3)
+        self.assertTrue(all(plans))
+
+
+class CoalitionTest(unittest.TestCase):
+
+    def testAssignGoals(self):
+        state = PassTest().get_start_state()
+        hunters = coalitions.hunters(state)
+        for c, partition in enumerate(coalitions.partitions(hunters)):
+            run_sim.assignGoals(state, c)
+            self.assertEqual(coalitions.goals(partition), state.goal)
+        self.assertEqual(c, 4)
+
+    def testCounts(self):
+        for n, bell in enumerate([1, 2, 5, 15, 52, 203], 1):
+            agents = ['h%d' % (i+1) for i in range(n)]
+            found = list(coalitions.partitions(agents))
+            self.assertEqual(len(found), bell)
+            self.assertEqual(len(set(found)), bell)
+            for partition in found:
+                self.assertEqual(sorted(sum(partition, ())), agents)
+        self.assertEqual(len(list(coalitions.goal_sets(agents, grand=False))), 202)
+
+    @unittest.skipUnless(numpy, 'needs numpy')
+    def testDecide(self):
+        state = scenarios.start_state((1, 0, 1), seed=5, hunters=4)
+        run_sim.decide(state)
+        self.assertEqual(set(state.assumes), set(coalitions.hunters(state)))
+
+
+class SymmetryTest(unittest.TestCase):
+
+    def get_state(self):
+        state = PassTest().get_start_state()
+        state.map = run_sim.map9x9x1
+        state.loc[('h1', 'hunter')] = (2,5)
+        state.target[('h1', 'hunter')] = ('s1', 'stag')
+        state.ready = [('h1', 'hunter')]
+        state.captured = [('r2', 'rabbit')]
+        del state.loc[('r2', 'rabbit')]
+        state.score[('h3', 'hunter')] = 2
+        return state
+
+    # state with its agents renamed and its cells moved by t
+    def transform(self, state, names, t):
+        rename = lambda agent: (names.get(agent[0], agent[0]), agent[1])
+        rename_all = lambda args: tuple(map(rename, args))
+        size = len(state.map), len(state.map[0])
+        new = models.staghunt_htn.get_start_state()
+        new.map = state.map
+        new.agents = rename_all(reversed(state.agents))
+        new.loc = models.staghunt_htn.LocIndex((rename(a), symmetry.apply(t, loc, *size)) for a, loc in state.loc.items())
+        new.target = dict((rename(a), rename(b)) for a, b in state.target.items())
+        new.goal = dict((rename(a), dict((k, rename_all(v)) for k, v in g.items())) for a, g in state.goal.items())
+        new.ready = rename_all(state.ready)
+        new.captured = rename_all(state.captured)
+        new.score = dict((rename(a), n) for a, n in state.score.items())
+        return new
+
+    def testMapGroup(self):
+        self.assertEqual(len(symmetry.map_group(run_sim.map9x9x1)), 4)
+        self.assertEqual(len(symmetry.map_group(run_sim.map5x5x1)), 2)
+        self.assertEqual(symmetry.map_group(run_sim.map5x5x3), ((False, False, False),))
+        # a symmetric map shares its distance fields between mirror images
+        grid = [list(column) for column in run_sim.map9x9x1]
+        analysis = a_start.MapAnalysis(tuple(map(tuple, grid)))
+        cells = [(x,y) for x in range(len(grid)) for y in range(len(grid[x])) if grid[x][y] > 0]
+        analysis.prefetch(cells)
+        self.assertLess(len(analysis.fields), len(cells))
+        for goal in cells:
+            for start in cells:
+                path = a_start.a_star_grid(grid, start, goal)
+                self.assertEqual(analysis.distance(start, goal), None if path is None else len(path))
+
+    def testCanonical(self):
+        state = self.get_state()
+        form = symmetry.canonical(state)
+        self.assertEqual(sorted(form.order), sorted(state.agents))
+        names = {'h1': 'h2', 'h2': 'h3', 'h3': 'h1', 's1': 's3', 's3': 's1'}
+        for t in symmetry.map_group(state.map):
+            other = symmetry.canonical(self.transform(state, names, t))
+            self.assertEqual(other, form)
+            self.assertEqual(hash(other), hash(form))
+            self.assertEqual(int(symmetry.Zobrist(self.transform(state, names, t))), int(symmetry.Zobrist(state)))
+        # swapping agents of different roles, or their goals, is another state
+        swapped = deepcopy(state)
+        swapped.loc[('h2', 'hunter')], swapped.loc[('r1', 'rabbit')] = state.loc[('r1', 'rabbit')], state.loc[('h2', 'hunter')]
+        self.assertNotEqual(symmetry.canonical(swapped), form)
+        state.goal[('h2', 'hunter')] = {'cooperateWith': (('h2', 'hunter'), ('h1', 'hunter'))}
+        self.assertNotEqual(symmetry.canonical(state), form)
+
+    def testZobrist(self):
+        state = self.get_state()
+        h = symmetry.Zobrist(state)
+        for agent, loc in [(('h2', 'hunter'), (3,1)), (('s2', 'stag'), (4,3)), (('h2', 'hunter'), (2,1))]:
+            before = h.view(state, agent)
+            state.loc[agent] = loc
+            h.changed(before, h.view(state, agent))
+            self.assertEqual(h.hashes, symmetry.Zobrist(state).hashes)
+        before = h.view(state, ('h2', 'hunter'))
+        state.score[('h2', 'hunter')] += 1
+        h.changed(before, h.view(state, ('h2', 'hunter')))
+        self.assertEqual(h.value(), symmetry.Zobrist(state).value())
+        # agents with the same view don't cancel out
+        hashes = set()
+        for change in ({'captured': [('r1', 'rabbit'), ('r2', 'rabbit')]}, {'loc': (1,1)}, {'loc': (5,5)}):
+            state = self.get_state()
+            state.captured = change.get('captured', [])
+            if 'loc' in change:
+                state.loc[('r1', 'rabbit')] = state.loc[('r2', 'rabbit')] = change['loc']
+            hashes.add(int(symmetry.Zobrist(state)))
+        self.assertEqual(len(hashes), 3)
+
+
+class EventsTest(unittest.TestCase):
+
+    def tearDown(self):
+        events.disable()
+
+    def testDisabledIsSilent(self):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            run_sim.simulate_state(PassTest().get_start_state(), 2, run_sim.decide)
+        self.assertEqual(out.getvalue(), '')
+
+    def testFileSink(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            events.enable(events.FileSink(path))
+            states,plans = run_sim.simulate_state(PassTest().get_start_state(), 2)
+            events.disable()
+            log = list(events.read_events(path))
+        finally:
+            os.remove(path)
+        maps = [args for kind, args in log if kind == 'map']
+        self.assertEqual([loc for _, loc in maps], [s.loc for s in states])
+        self.assertEqual([args[0] for kind, args in log if kind == 'plan'], plans)
+        self.assertIn('next_step', [kind for kind, _ in log])
+
+    def testPrintSink(self):
+        out = io.StringIO()
+        events.enable(events.PrintSink())
+        with contextlib.redirect_stdout(out):
+            models.staghunt_htn.betray(PassTest().get_start_state(), ('h1', 'hunter'))
+        self.assertEqual(out.getvalue(), "betray ('h1', 'hunter')\n")
+
 
 if __name__ == '__main__':
     unittest.main()
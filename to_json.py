@@ -1,4 +1,5 @@
-import pickle
+import sys
+import shards
 
 def print_rows(rows, indent):
 	l = len(rows)
@@ -11,7 +12,7 @@ def print_rows(rows, indent):
 
 def map_to_json(sim_map):
 	print('  "map":[')
-	print(',\n'.join(['      '+str(x) for x in sim_map]))
+	print(',\n'.join(['      '+str(list(x)) for x in sim_map]))
 	print('    ],')
 
 def location_to_json(agent, loc):
@@ -34,10 +35,8 @@ def sim_to_json(states, sim_id):
 	print('}')
 
 if __name__ == '__main__':
-    all_data = pickle.load(open('all.pickle', 'rb'))
-    for i, cond1 in enumerate(all_data):
-        for j, cond2 in enumerate(cond1):
-            for k, cond3 in enumerate(cond2):
-                for c, (states, plans) in enumerate(cond3):
-                	sim_to_json(states, f'sim-{i}-{j}-{k}-{c}')
+    # all.pickle or a directory of sweep shards
+    path = sys.argv[1] if len(sys.argv) > 1 else 'all.pickle'
+    for (i, j, k, c), (states, plans) in shards.iter_runs(path):
+        sim_to_json(states, f'sim-{i}-{j}-{k}-{c}')
 
@@ -0,0 +1,99 @@
+from collections.abc import Sequence
+from copy import deepcopy
+from pyhop import LRUCache, state_vars
+
+# a run stored as its first state and the actions of each step's plan,
+# instead of a full copy of the state after every step. the states are
+# rebuilt on demand by replaying the actions with the domain's operators,
+# the way simulate_state applies each plan. whatever replay doesn't
+# reproduce, the goals and assumptions decide() sets before each step, is
+# stored for the steps where it changes
+
+_domain = None
+
+def default_domain():
+    global _domain
+    if _domain is None:
+        import models.staghunt_htn
+        _domain = models.staghunt_htn.load_domain()
+    return _domain
+
+
+# reads like the list of states of a run: len(), t[s], iteration
+class Trajectory(Sequence):
+
+    def __init__(self, initial, actions, decisions=None, domain=None, cache_size=8):
+        self.initial = initial
+        # the tasks of each step's plan
+        self.actions = actions
+        # step -> {name: value} of state variables set outside the plan
+        self.decisions = decisions or {}
+        self.domain = domain
+        self.cache = LRUCache(cache_size)
+
+    # the trajectory of a (states, plans) run from simulate_state
+    @classmethod
+    def from_run(cls, states, plans, domain=None, cache_size=8):
+        trajectory = cls(deepcopy(states[0]), [[step[0] for step in plan] for plan in plans], {}, domain, cache_size)
+        state = trajectory.initial
+        for s in range(1, len(states)):
+            state = trajectory.replay(state, s)
+            actual = state_vars(states[s])
+            replayed = state_vars(state)
+            changed = [name for name, val in actual.items() if name not in replayed or replayed[name] != val]
+            if changed:
+                # copied together, so they keep sharing what they shared
+                trajectory.decisions[s] = deepcopy(dict((name, actual[name]) for name in changed))
+                for name, val in deepcopy(trajectory.decisions[s]).items():
+                    setattr(state, name, val)
+        return trajectory
+
+    # the plans of the run, each step as a (task,) tuple
+    @property
+    def plans(self):
+        return [[(task,) for task in tasks] for tasks in self.actions]
+
+    # the state after step s-1's actions and step s's decisions
+    def replay(self, state, s):
+        operators = (self.domain or default_domain()).operators
+        state = deepcopy(state)
+        for task in self.actions[s-1]:
+            operators[task[0]](state, *task[1:])
+        if s in self.decisions:
+            for name, val in deepcopy(self.decisions[s]).items():
+                setattr(state, name, val)
+        return state
+
+    def __len__(self):
+        return len(self.actions) + 1
+
+    def __getitem__(self, s):
+        if isinstance(s, slice):
+            return [self[i] for i in range(*s.indices(len(self)))]
+        if s < 0:
+            s += len(self)
+        if not 0 <= s < len(self):
+            raise IndexError('trajectory index out of range')
+        if s == 0:
+            return self.initial
+        # replay from the closest state already rebuilt
+        start = max([i for i in self.cache.entries if i <= s], default=0)
+        state = self.cache.get(start) if start else self.initial
+        for i in range(start+1, s+1):
+            state = self.replay(state, i)
+        self.cache.put(s, state)
+        return state
+
+    def __iter__(self):
+        state = self.initial
+        yield state
+        for s in range(1, len(self)):
+            state = self.replay(state, s)
+            yield state
+
+    # pickle only what the states are rebuilt from
+    def __getstate__(self):
+        return {'initial': self.initial, 'actions': self.actions, 'decisions': self.decisions}
+
+    def __setstate__(self, d):
+        self.__init__(d['initial'], d['actions'], d['decisions'])